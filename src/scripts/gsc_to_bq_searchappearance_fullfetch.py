@@ -10,17 +10,17 @@
 # =================================================
 
 from google.oauth2 import service_account
-from googleapiclient.discovery import build
 from google.cloud import bigquery
 import pandas as pd
 from datetime import datetime, timedelta
 import hashlib
 import time
 import os
-import json
 import argparse
 import warnings
 import uuid
+from utils.gsc_key_utils import ExistingKeySet, sha256_hex_list
+from utils.gsc_api_utils import build_searchconsole, load_service_account_info
 
 # =================================================
 # BLOCK 1: CONFIGURATION & ARGUMENT PARSING
@@ -31,7 +31,8 @@ BQ_DATASET = 'seo_reports'
 BQ_TABLE_RAW = 'bamtabridsazan__temp_gsc__raw_domain_data_searchappearance'
 BQ_TABLE_ALLOC = 'bamtabridsazan__temp_gsc__allocated_searchappearance'
 ROW_LIMIT = 25000
-RETRY_DELAY = 60  # seconds in case of timeout
+GSC_FIELDS = "rows(keys,clicks,impressions,ctr,position)"  # response field mask: only what the loaders read
+GSC_NUM_RETRIES = 5  # retries with exponential backoff on 429/5xx for queries re-sent outside a batch
 
 parser = argparse.ArgumentParser(description="GSC SearchAppearance to BigQuery Full Fetch")
 parser.add_argument("--start-date", type=str, help="Start date YYYY-MM-DD for full fetch (inclusive)")
@@ -59,24 +60,25 @@ FETCH_ID = f"{datetime.utcnow().strftime('%Y%m%d_%H%M%S')}_{uuid.uuid4().hex[:6]
 # BLOCK 3: CREDENTIALS & SERVICE CLIENTS
 # =================================================
 SERVICE_ACCOUNT_FILE = os.environ.get("SERVICE_ACCOUNT_FILE", "gcp-key.json")
-with open(SERVICE_ACCOUNT_FILE, "r") as f:
-    sa_info = json.load(f)
+sa_info = load_service_account_info(SERVICE_ACCOUNT_FILE)
 credentials = service_account.Credentials.from_service_account_info(sa_info)
-service = build('searchconsole', 'v1', credentials=credentials)
+service = build_searchconsole(credentials)
 bq_client = bigquery.Client(credentials=credentials, project=BQ_PROJECT)
 
 # =================================================
 # BLOCK 4: HELPER FUNCTIONS (Keys & Table Setup)
 # =================================================
-def stable_key(row):
+def stable_key_series(df):
     """
-    Unique key for RAW rows is SHA256 of "searchappearance|Date|SearchType".
+    Unique key for RAW rows: SHA256 hex of "searchappearance|SearchType|Date" (SearchAppearance
+    stripped and lowercased, NULLs as ''). Normalization runs as .str ops over the whole frame,
+    then one hashing pass over the joined strings.
     """
-    sa = (row.get('SearchAppearance') or '').strip().lower()
-    date = str(row.get('Date') or '')
-    stype = str(row.get('SearchType') or '')
-    s = f"{sa}|{stype}|{date}"
-    return hashlib.sha256(s.encode('utf-8')).hexdigest()
+    sa = df['SearchAppearance'].fillna('').astype(str).str.strip().str.lower()
+    date = df['Date'].fillna('').astype(str)
+    stype = df['SearchType'].fillna('').astype(str)
+    joined = sa + '|' + stype + '|' + date
+    return sha256_hex_list(joined)
 
 def ensure_table(table_name=BQ_TABLE_RAW):
     dataset_ref = bq_client.dataset(BQ_DATASET)
@@ -119,14 +121,27 @@ def ensure_table(table_name=BQ_TABLE_RAW):
         bq_client.create_table(table)
         print(f"[INFO] Table {table_name} created.", flush=True)
 
-def get_existing_keys(table_name=BQ_TABLE_RAW):
+def date_window_params(start_date, end_date):
+    """@start_date/@end_date DATE query parameters: typed by BigQuery, no dates spliced into the SQL text."""
+    return [
+        bigquery.ScalarQueryParameter("start_date", "DATE", start_date),
+        bigquery.ScalarQueryParameter("end_date", "DATE", end_date),
+    ]
+
+def get_existing_keys(table_name=BQ_TABLE_RAW, start_date=None, end_date=None):
     try:
         query = f"SELECT unique_key FROM `{BQ_PROJECT}.{BQ_DATASET}.{table_name}`"
-        df = bq_client.query(query).to_dataframe()
-        return set(df['unique_key'].astype(str).tolist())
+        job_config = None
+        if start_date and end_date:
+            # RAW keys embed the Date, so only rows inside the fetch window can collide
+            query += " WHERE Date BETWEEN @start_date AND @end_date"
+            job_config = bigquery.QueryJobConfig(query_parameters=date_window_params(start_date, end_date))
+        keys = bq_client.query(query, job_config=job_config).result().to_arrow().column('unique_key').to_pylist()
+        # 8-byte key prefixes in a sorted array instead of 64-char hex strs in a set
+        return ExistingKeySet(keys)
     except Exception as e:
         print(f"[WARN] Failed to fetch existing keys from {table_name}: {e}", flush=True)
-        return set()
+        return ExistingKeySet()
 
 def fetch_mapping():
     """
@@ -143,94 +158,124 @@ def fetch_mapping():
 # =================================================
 # BLOCK 5: FETCH DATA FROM GSC
 # =================================================
+GSC_BATCH_SIZE = 10  # (day, SearchType) queries per multipart BatchHttpRequest; small enough to stay clear of 429s
+
+def searchappearance_query(day, stype):
+    request = {
+        'startDate': day,
+        'endDate': day,
+        'dimensions': ['searchAppearance'],
+        'rowLimit': ROW_LIMIT,
+        'searchType': stype
+    }
+    return service.searchanalytics().query(siteUrl=SITE_URL, body=request, fields=GSC_FIELDS)
+
+def fetch_searchappearance_batches(plan):
+    """
+    Run one searchAppearance query per (day, SearchType) in `plan`, GSC_BATCH_SIZE at a time
+    through BatchHttpRequest (one multipart HTTP round-trip per batch instead of one call per query).
+    A query that failed inside its batch is re-sent on its own with execute(num_retries=GSC_NUM_RETRIES).
+    Returns a list aligned with `plan`: the rows of each query, or the Exception it finally failed with.
+    """
+    results = {}
+
+    def collect(request_id, response, exception):
+        results[request_id] = exception if exception is not None else response.get('rows', [])
+
+    for start in range(0, len(plan), GSC_BATCH_SIZE):
+        batch = service.new_batch_http_request(callback=collect)
+        for idx in range(start, min(start + GSC_BATCH_SIZE, len(plan))):
+            batch.add(searchappearance_query(*plan[idx]), request_id=str(idx))
+        try:
+            batch.execute()
+        except Exception as e:
+            print(f"[WARN] GSC batch request failed ({e}); re-sending its queries one by one.", flush=True)
+
+        for idx in range(start, min(start + GSC_BATCH_SIZE, len(plan))):
+            if not isinstance(results.get(str(idx)), list):
+                try:
+                    results[str(idx)] = searchappearance_query(*plan[idx]).execute(num_retries=GSC_NUM_RETRIES).get('rows', [])
+                except Exception as e:
+                    results[str(idx)] = e
+
+    return [results[str(idx)] for idx in range(len(plan))]
+
 def fetch_searchappearance_data(start_date, end_date):
-    existing_keys = get_existing_keys(BQ_TABLE_RAW)
+    existing_keys = get_existing_keys(BQ_TABLE_RAW, start_date, end_date)
     mapping_df = fetch_mapping()
     print(f"[INFO] Fetching SearchAppearance data from {start_date} to {end_date}", flush=True)
 
     start_dt = datetime.strptime(start_date, "%Y-%m-%d").date()
     end_dt = datetime.strptime(end_date, "%Y-%m-%d").date()
-    all_rows = []
     batch_reports = {}
 
     # default SearchTypes for GSC
     search_types = ["web", "image", "video", "news"]
 
-    for i in range((end_dt - start_dt).days + 1):
-        cur_date = start_dt + timedelta(days=i)
-        cur_date_str = cur_date.strftime("%Y-%m-%d")
-        for stype in search_types:
-            real_rows_count = 0
-            placeholder_count = 0
-            fetch_error = False
-
-            request = {
-                'startDate': cur_date_str,
-                'endDate': cur_date_str,
-                'dimensions': ['searchAppearance'],
-                'rowLimit': ROW_LIMIT,
-                'searchType': stype
-            }
-            try:
-                resp = service.searchanalytics().query(siteUrl=SITE_URL, body=request).execute()
-                rows = resp.get('rows', [])
-            except Exception as e:
-                print(f"[ERROR] Day {cur_date_str} fetch failed: {e}", flush=True)
-                rows = []
-                fetch_error = True
-
-            if not rows:
-                placeholder_sa = "__NO_APPEARANCE__"
-                key_material = f"{placeholder_sa}|{stype}|{cur_date_str}"
-                key = hashlib.sha256(key_material.encode()).hexdigest()
-                if key not in existing_keys:
-                    existing_keys.add(key)
-                    all_rows.append({
-                        'Date': cur_date_str,
-                        'SearchAppearance': placeholder_sa,
-                        'Clicks': 0,
-                        'Impressions': 0,
-                        'CTR': 0.0,
-                        'Position': 0.0,
-                        'SearchType': stype,
-                        'fetch_date': FETCH_DATE,
-                        'fetch_id': FETCH_ID,
-                        'unique_key': key
-                    })
-                    placeholder_count = 1
+    # every (day, SearchType) query is planned up front and sent in multipart batches
+    plan = [
+        ((start_dt + timedelta(days=i)).strftime("%Y-%m-%d"), stype)
+        for i in range((end_dt - start_dt).days + 1)
+        for stype in search_types
+    ]
+    results = fetch_searchappearance_batches(plan)
+
+    # collect every returned row (and one placeholder per empty day/SearchType) column-wise,
+    # then hash the whole run in one pass instead of an f-string + sha256 per row
+    cols = {c: [] for c in ['Date', 'SearchAppearance', 'SearchType', 'Clicks', 'Impressions', 'CTR', 'Position']}
+    row_plan_idx = []
+    fetch_errors = set()
+    placeholder_sa = "__NO_APPEARANCE__"
+
+    for plan_idx, ((cur_date_str, stype), result) in enumerate(zip(plan, results)):
+        if isinstance(result, Exception):
+            print(f"[ERROR] Day {cur_date_str} fetch failed: {result}", flush=True)
+            rows = []
+            fetch_errors.add(plan_idx)
+        else:
+            rows = result
+
+        if not rows:
+            rows = [{'keys': [placeholder_sa]}]
+        n = len(rows)
+        cols['Date'] += [cur_date_str] * n
+        cols['SearchAppearance'] += [r['keys'][0] for r in rows]
+        cols['SearchType'] += [stype] * n
+        cols['Clicks'] += [r.get('clicks',0) for r in rows]
+        cols['Impressions'] += [r.get('impressions',0) for r in rows]
+        cols['CTR'] += [r.get('ctr',0.0) for r in rows]
+        cols['Position'] += [r.get('position',0.0) for r in rows]
+        row_plan_idx += [plan_idx] * n
+
+    df_all = pd.DataFrame(cols)
+    # key material is the raw (un-normalized) SearchAppearance, as stored in RAW so far
+    keys = sha256_hex_list(df_all['SearchAppearance'].astype(str) + '|' + df_all['SearchType'] + '|' + df_all['Date'])
+
+    is_new = existing_keys.add_new(keys)
+    real_counts = [0] * len(plan)
+    placeholder_counts = [0] * len(plan)
+    for new, plan_idx, sa in zip(is_new, row_plan_idx, cols['SearchAppearance']):
+        if new:
+            if sa == placeholder_sa:
+                placeholder_counts[plan_idx] = 1
             else:
-                for r in rows:
-                    sa = r['keys'][0]
-                    clicks = r.get('clicks',0)
-                    impressions = r.get('impressions',0)
-                    ctr = r.get('ctr',0.0)
-                    position = r.get('position',0.0)
-                    key_material = f"{sa}|{stype}|{cur_date_str}"
-                    key = hashlib.sha256(key_material.encode()).hexdigest()
-                    if key not in existing_keys:
-                        existing_keys.add(key)
-                        all_rows.append({
-                            'Date': cur_date_str,
-                            'SearchAppearance': sa,
-                            'SearchType': stype,
-                            'Clicks': clicks,
-                            'Impressions': impressions,
-                            'CTR': ctr,
-                            'Position': position,
-                            'SearchType': stype,
-                            'fetch_date': FETCH_DATE,
-                            'fetch_id': FETCH_ID,
-                            'unique_key': key
-                        })
-                        real_rows_count += 1
-
-            # Batch report per SearchType
-            batch_reports.setdefault(stype, []).append((cur_date_str, real_rows_count, placeholder_count, fetch_error))
-
-    df_batch = pd.DataFrame(all_rows)
+                real_counts[plan_idx] += 1
+
+    for plan_idx, (cur_date_str, stype) in enumerate(plan):
+        # Batch report per SearchType
+        batch_reports.setdefault(stype, []).append(
+            (cur_date_str, real_counts[plan_idx], placeholder_counts[plan_idx], plan_idx in fetch_errors)
+        )
+
+    df_all['fetch_date'] = FETCH_DATE
+    df_all['fetch_id'] = FETCH_ID
+    df_all['unique_key'] = keys
+    df_batch = df_all[is_new].reset_index(drop=True) if len(df_all) else pd.DataFrame()
     if not df_batch.empty:
-        df_batch['Date'] = pd.to_datetime(df_batch['Date']).dt.date
-        df_batch['fetch_date'] = pd.to_datetime(df_batch['fetch_date']).dt.date
+        # GSC and placeholder dates are always 'YYYY-MM-DD': explicit format (C fast path, no inference),
+        # cache=True parses each distinct day once; fetch_date is one constant for the whole run
+        df_batch['Date'] = pd.to_datetime(df_batch['Date'], format='%Y-%m-%d', cache=True).dt.date
+        df_batch['fetch_date'] = datetime.strptime(FETCH_DATE, '%Y-%m-%d').date()
 
     # Print batch report per SearchType
     print("[INFO] Batch report per SearchType:", flush=True)
@@ -259,34 +304,50 @@ def upload_to_bq(df, table_name):
         df[col] = pd.to_numeric(df[col], errors='coerce').fillna(0)
 
     if 'unique_key' not in df.columns:
-        df['unique_key'] = df.apply(lambda r: stable_key(r), axis=1)
+        df['unique_key'] = stable_key_series(df)
 
-    # remove duplicates
     full_table_id = f"{BQ_PROJECT}.{BQ_DATASET}.{table_name}"
-    try:
-        existing_df = bq_client.query(f"SELECT unique_key FROM `{full_table_id}`").to_dataframe()
-        existing_keys = set(existing_df['unique_key'].dropna().tolist())
-    except Exception:
-        existing_keys = set()
-    df_filtered = df[~df['unique_key'].isin(existing_keys)].copy()
-    skipped = len(df)-len(df_filtered)
-    print(f"[INFO] {len(df_filtered)} new rows to insert, {skipped} duplicates skipped.", flush=True)
-
-    if df_filtered.empty:
-        return
 
     if DEBUG_MODE:
+        # debug: no writes, so the duplicate check stays client-side
+        try:
+            existing_col = bq_client.query(f"SELECT unique_key FROM `{full_table_id}` WHERE unique_key IS NOT NULL").result().to_arrow().column('unique_key')
+            existing_keys = set(existing_col.to_pylist())
+        except Exception:
+            existing_keys = set()
+        df_filtered = df[~df['unique_key'].isin(existing_keys)].copy()
+        print(f"[INFO] {len(df_filtered)} new rows to insert, {len(df)-len(df_filtered)} duplicates skipped.", flush=True)
+        if df_filtered.empty:
+            return
         csv_file = args.csv_test or f"gsc_searchappearance_test_{FETCH_ID}.csv"
         df_filtered.to_csv(csv_file, index=False)
         print(f"[DEBUG] Debug mode ON. Wrote {len(df_filtered)} rows to {csv_file}. Not uploading to BigQuery.", flush=True)
         return
 
+    # remove duplicates server-side: stage the batch, then MERGE ... WHEN NOT MATCHED
+    # (no unique_key scan shipped to the client, no Python set)
+    stage_table_id = f"{full_table_id}__stage_{FETCH_ID}"
     try:
-        job_config = bigquery.LoadJobConfig(write_disposition="WRITE_APPEND")
-        bq_client.load_table_from_dataframe(df_filtered, full_table_id, job_config=job_config).result()
-        print(f"[INFO] Inserted {len(df_filtered)} rows to {full_table_id}.", flush=True)
+        job_config = bigquery.LoadJobConfig(
+            write_disposition="WRITE_TRUNCATE",
+            schema=bq_client.get_table(full_table_id).schema,
+        )
+        bq_client.load_table_from_dataframe(df, stage_table_id, job_config=job_config).result()
+        merge_sql = f"""
+            MERGE `{full_table_id}` T
+            USING `{stage_table_id}` S
+            ON T.unique_key = S.unique_key
+            WHEN NOT MATCHED THEN INSERT ROW
+        """
+        merge_job = bq_client.query(merge_sql)
+        merge_job.result()
+        inserted = merge_job.num_dml_affected_rows or 0
+        print(f"[INFO] {inserted} new rows to insert, {len(df)-inserted} duplicates skipped.", flush=True)
+        print(f"[INFO] Inserted {inserted} rows to {full_table_id}.", flush=True)
     except Exception as e:
         print(f"[ERROR] Failed to insert rows: {e}", flush=True)
+    finally:
+        bq_client.delete_table(stage_table_id, not_found_ok=True)
 
 # =================================================
 # BLOCK 7: ALLOCATION (Direct allocation)
@@ -318,12 +379,10 @@ def direct_allocation(df_raw, mapping_df):
     df['Position_alloc'] = df['Position']
 
     # ✅ unique_key شامل SearchAppearance + TargetEntity + Date + SearchType + fetch_id
-    df['unique_key'] = df.apply(
-        lambda r: hashlib.sha256(
-            f"{r['SearchAppearance']}|{r['TargetEntity']}|{r['Date']}|{r['SearchType']}|{r['fetch_id']}".encode()
-        ).hexdigest(),
-        axis=1
-    )
+    df['unique_key'] = [
+        hashlib.sha256(f"{sa}|{target}|{date}|{stype}|{fetch_id}".encode()).hexdigest()
+        for sa, target, date, stype, fetch_id in df[['SearchAppearance','TargetEntity','Date','SearchType','fetch_id']].itertuples(index=False, name=None)
+    ]
 
     df_alloc = df[[
         'Date','SearchAppearance','TargetEntity','AllocationMethod','AllocationWeight',
@@ -347,8 +406,9 @@ def main():
     upload_to_bq(df_new, BQ_TABLE_RAW)
 
     if df_new is None or df_new.empty:
-        query = f"SELECT * FROM `{BQ_PROJECT}.{BQ_DATASET}.{BQ_TABLE_RAW}` WHERE Date >= '{START_DATE}' AND Date <= '{END_DATE}'"
-        df_new = bq_client.query(query).to_dataframe()
+        query = f"SELECT * FROM `{BQ_PROJECT}.{BQ_DATASET}.{BQ_TABLE_RAW}` WHERE Date >= @start_date AND Date <= @end_date"
+        job_config = bigquery.QueryJobConfig(query_parameters=date_window_params(START_DATE, END_DATE))
+        df_new = bq_client.query(query, job_config=job_config).to_dataframe()
         if not df_new.empty:
             df_new['Date'] = pd.to_datetime(df_new['Date']).dt.date
 
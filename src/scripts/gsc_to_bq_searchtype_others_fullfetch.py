@@ -10,16 +10,43 @@
 
 import os
 import sys
-import time
-import hashlib
+import functools
 import argparse
 import warnings
 import pandas as pd
-from datetime import datetime
+import pyarrow as pa
+import pyarrow.parquet as pq
+import tempfile
+from datetime import date, datetime, timedelta
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import quote
 from google.oauth2 import service_account
-from googleapiclient.discovery import build
+from google.auth.transport.requests import AuthorizedSession
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+# orjson is optional: parses the ~5-10 MB page responses several times faster than stdlib json
+try:
+    import orjson
+except ImportError:
+    orjson = None
 from google.cloud import bigquery
 from utils.gsc_country_utils import load_country_map, robust_map_country_column
+from utils.gsc_key_utils import ExistingKeySet, generate_expanded_unique_keys, key_prefix64
+from utils.gsc_api_utils import load_service_account_info
+
+# google-cloud-storage is optional: only needed to stage large spool files in GCS_STAGING_BUCKET
+try:
+    from google.cloud import storage
+except ImportError:
+    storage = None
+
+# Storage Write API uploader is optional: without google-cloud-bigquery-storage/protobuf, upload_to_bq uses load jobs
+try:
+    from utils.gsc_storage_write import AppendRowsError, append_dataframe
+except ImportError:
+    append_dataframe = None
 
 # ---------- MAIN CONFIG ----------
 SITE_URL = "sc-domain:bamtabridsazan.com"
@@ -27,8 +54,16 @@ BQ_PROJECT = "bamtabridsazan"
 BQ_DATASET = "seo_reports"
 BQ_TABLE = "00_06__temp_bamtabridsazan__gsc__raw_domain_data_othersearchtype_fullfetch"
 ROW_LIMIT = 25000
-RETRY_DELAY = 60  # seconds
+GSC_FIELDS = "rows(keys,clicks,impressions,ctr,position)"  # response field mask: only what the loaders read
+GSC_NUM_RETRIES = 5  # retries with exponential backoff on 429/5xx (honours Retry-After) instead of a flat 60 s sleep
+PREFETCH_PAGES = 4  # GSC pages requested concurrently per dimension batch
+BATCH_LOOKAHEAD = 3  # later (dims, searchType) pairs whose first page group is fetched while the current one pages
+FETCH_WORKERS = (1 + BATCH_LOOKAHEAD) * PREFETCH_PAGES  # 16 requests in flight, under GSC's 20 QPS per-user limit
+HTTP_TIMEOUT = 300  # seconds per GSC page request
+MAX_PENDING_UPLOADS = 2  # finished batches allowed to queue behind the background uploader
 SERVICE_ACCOUNT_FILE = os.environ.get("SERVICE_ACCOUNT_FILE", "gcp-key.json")
+GCS_STAGING_BUCKET = os.environ.get("GCS_STAGING_BUCKET")  # optional: load large spool files from gs:// instead of POSTing them
+GCS_STAGING_MIN_BYTES = 1 << 30  # spool size from which the GCS hop pays off
 # ensure image is present first to avoid accidental omission
 SEARCH_TYPES = ['image', 'video', 'news']
 
@@ -38,42 +73,48 @@ parser.add_argument("--start-date", required=True, help="Start date YYYY-MM-DD")
 parser.add_argument("--end-date", required=True, help="End date YYYY-MM-DD")
 parser.add_argument("--debug", action="store_true", help="Debug: skip BQ insert (still creates CSV if requested)")
 parser.add_argument("--csv-test", required=False, help="Optional CSV test output filename")
+parser.add_argument("--server-dedup", action="store_true", help="Skip the existing-keys download: stage the rows and MERGE new keys in BigQuery")
 args = parser.parse_args()
 
 START_DATE = args.start_date
 END_DATE = args.end_date
 DEBUG_MODE = args.debug
 CSV_TEST_FILE = args.csv_test
+SERVER_DEDUP = args.server_dedup
 
 # ---------- CLIENTS ----------
+# one service-account Credentials object for the whole process (GSC, BigQuery, Storage Read/Write, GCS):
+# the key file is read and the RSA signer set up once, and the GSC service reuses its discovery
+# document and HTTP connection across the batches
+GCP_SCOPES = [
+    "https://www.googleapis.com/auth/webmasters.readonly",
+    "https://www.googleapis.com/auth/cloud-platform",
+]
+
+@functools.lru_cache(maxsize=1)
 def get_credentials():
-    creds = service_account.Credentials.from_service_account_file(
-        SERVICE_ACCOUNT_FILE,
-        scopes=["https://www.googleapis.com/auth/webmasters.readonly"]
+    return service_account.Credentials.from_service_account_info(
+        load_service_account_info(SERVICE_ACCOUNT_FILE),
+        scopes=GCP_SCOPES,
     )
-    return creds
 
+@functools.lru_cache(maxsize=1)
 def get_bq_client():
-    creds_for_bq = service_account.Credentials.from_service_account_file(SERVICE_ACCOUNT_FILE)
-    return bigquery.Client(credentials=creds_for_bq, project=creds_for_bq.project_id)
-
-def get_gsc_service():
-    creds_for_gsc = service_account.Credentials.from_service_account_file(
-        SERVICE_ACCOUNT_FILE,
-        scopes=["https://www.googleapis.com/auth/webmasters.readonly"]
-    )
-    return build("searchconsole", "v1", credentials=creds_for_gsc)
+    creds = get_credentials()
+    return bigquery.Client(credentials=creds, project=creds.project_id)
 
 bq_client = get_bq_client()
 table_ref = bq_client.dataset(BQ_DATASET).table(BQ_TABLE)
+# --server-dedup: this run's rows go to a staging table, merged into table_ref by merge_staging_table()
+staging_ref = bq_client.dataset(BQ_DATASET).table(f"{BQ_TABLE}__stage_{datetime.utcnow().strftime('%Y%m%d%H%M%S')}")
+upload_ref = staging_ref if SERVER_DEDUP else table_ref
 
 # ---------- COUNTRY MAPPING ----------
-client = bigquery.Client()
 query = """
     SELECT country_code_alpha3 AS country_code, country_name
     FROM `bamtabridsazan.seo_reports.00_00_gsc_dim_country`
 """
-df_country = client.query(query).to_dataframe()
+df_country = bq_client.query(query).to_dataframe()
 df_country["country_code"] = df_country["country_code"].str.upper()
 COUNTRY_MAP = dict(zip(df_country["country_code"], df_country["country_name"]))
 
@@ -123,128 +164,392 @@ def ensure_table_and_schema():
             bigquery.SchemaField("unique_key", "STRING"),
         ]
         table = bigquery.Table(table_ref, schema=schema)
+        # day partitions on Date: the run's date-bounded key reads and MERGEs only scan the days they touch
+        table.time_partitioning = bigquery.TimePartitioning(type_=bigquery.TimePartitioningType.DAY, field="Date")
         table.clustering_fields = ["Page", "Query", "Country", "Device"]
         bq_client.create_table(table)
         print(f"[INFO] Table {BQ_TABLE} created with SearchType field.", flush=True)
 
 # ---------- UNIQUE KEY ----------
-def generate_expanded_unique_key(row, dims):
+
+# ---------- STORAGE READ API: unique_key column only ----------
+READ_STREAMS = 4  # parallel Storage Read API streams for the existing-keys load
+
+def read_unique_keys_storage(row_restriction=""):
     """
-    Generate a unique SHA256 hash key based on the 'Duplicated in Expanded Dimension Space'.
-    
-    Parameters:
-    - row: dict-like object containing the row data (e.g., {'Date': ..., 'Query': ..., 'Page': ..., ...})
-    - dims: list of dimension names (strings) that define the uniqueness for this row
-            e.g., ['date', 'query', 'page', 'country', 'device']
-
-    Mechanism:
-    - Only the dimensions present in 'dims' are considered for uniqueness
-    - Missing or None values are normalized to empty string
-    - String values are stripped and lowercased
-    - Date values are converted to 'YYYY-MM-DD' string
-    - The concatenated string of all dimension values is hashed using SHA256
+    Stream only the unique_key column straight from table storage as Arrow
+    (BigQuery Storage Read API): no query job, no tabledata.list JSON pages, no DataFrame.
+    Returns the keys as uint64 prefix arrays (see key_prefix64), one per Arrow record batch.
     """
-    # canonical mapping: lowercase dim -> actual column name in row dict
-    canonical = {
-        "date": "Date",
-        "query": "Query",
-        "page": "Page",
-        "country": "Country",
-        "device": "Device"
-    }   
-    key_parts = []
-
-    for dim in dims:
-        dim_lower = str(dim).lower()
-        col = canonical.get(dim_lower, None)
-
-        # try several fallbacks to find the value in row
-        val = ""
-        if col and col in row:
-            val = row.get(col)
-        else:
-            # fallback attempts: original dim as-is, lowercase, uppercase
-            val = row.get(dim) if dim in row else row.get(dim_lower) if dim_lower in row else row.get(dim.upper(), None)
-        
-        # Normalize None to empty string
-        if val is None:
-            val = ""
-        # Handle date normalization
-        if dim_lower == "date":
-            if isinstance(val, str):
-                val = val[:10]
-            elif isinstance(val, datetime):
-                val = val.strftime("%Y-%m-%d")
-            else:
-                val = str(val)[:10] if val != "" else ""
-        else:
-            val = str(val).strip().lower()
-            if dim_lower == "page" and val:
-                val = val.rstrip("/")  # normalize trailing slash
-
-        key_parts.append(val)
+    from google.cloud import bigquery_storage_v1
+    from google.cloud.bigquery_storage_v1 import types
+
+    read_client = bigquery_storage_v1.BigQueryReadClient(credentials=get_credentials())
+    session = read_client.create_read_session(
+        parent=f"projects/{BQ_PROJECT}",
+        read_session=types.ReadSession(
+            table=f"projects/{BQ_PROJECT}/datasets/{BQ_DATASET}/tables/{BQ_TABLE}",
+            data_format=types.DataFormat.ARROW,
+            read_options=types.ReadSession.TableReadOptions(
+                selected_fields=["unique_key"],
+                row_restriction=row_restriction,
+            ),
+        ),
+        max_stream_count=READ_STREAMS,
+    )
 
-    key_str = "|".join(key_parts)
-    # optional DEBUG: print the key parts (enable only while testing)
-    # print("DEBUG key_fields:", {d: row.get(canonical.get(d.lower(), d), "") for d in dims}, "-> unique:", hashlib.sha256(key_str.encode("utf-8")).hexdigest())
-    return hashlib.sha256(key_str.encode("utf-8")).hexdigest()
+    def read_stream(stream):
+        # record batch by record batch: each batch is reduced to 8-byte prefixes as it arrives,
+        # so the whole column never exists as one Arrow table plus one Python str per key
+        pages = read_client.read_rows(stream.name).rows(session).pages
+        return [key_prefix64(page.to_arrow().column("unique_key").to_pylist()) for page in pages]
 
+    prefix_chunks = []
+    with ThreadPoolExecutor(max_workers=READ_STREAMS) as pool:
+        for stream_chunks in pool.map(read_stream, session.streams):
+            prefix_chunks.extend(stream_chunks)
+    return prefix_chunks
 
 # ---------- GET EXISTING KEYS (LIMITED BY DATE RANGE) ----------
+def date_window_params(start_date, end_date):
+    """@start_date/@end_date DATE query parameters: typed by BigQuery, no dates spliced into the SQL text."""
+    return [
+        bigquery.ScalarQueryParameter("start_date", "DATE", start_date),
+        bigquery.ScalarQueryParameter("end_date", "DATE", end_date),
+    ]
+
 def get_existing_keys(start_date, end_date):
+    if SERVER_DEDUP:
+        print("[INFO] Server-side dedup: existing keys not downloaded; new keys are merged in BigQuery at the end.", flush=True)
+        return ExistingKeySet()
+    # parsed once, before the fallback handler: a malformed --start-date/--end-date raises instead of
+    # yielding an empty key set, and only validated dates end up in the Storage Read filter text
+    start_date, end_date = date.fromisoformat(start_date), date.fromisoformat(end_date)
     try:
-        query = (
-            f"SELECT unique_key FROM `{BQ_PROJECT}.{BQ_DATASET}.{BQ_TABLE}` "
-            f"WHERE Date BETWEEN '{start_date}' AND '{end_date}'"
-        )
+        date_filter = f"Date BETWEEN '{start_date.isoformat()}' AND '{end_date.isoformat()}'"
         try:
-            from google.cloud import bigquery_storage
-            bqstorage_client = bigquery_storage.BigQueryReadClient()
-            df = bq_client.query(query).to_dataframe(bqstorage_client=bqstorage_client)
-        except Exception:
-            with warnings.catch_warnings():
-                warnings.simplefilter("ignore")
-                df = bq_client.query(query).to_dataframe()
-        print(f"[INFO] Retrieved {len(df)} existing keys from BigQuery (date-filtered).", flush=True)
-        return set(df["unique_key"].astype(str).tolist())
+            keys = ExistingKeySet.from_prefixes(read_unique_keys_storage(row_restriction=date_filter))
+            print(f"[INFO] Retrieved {len(keys)} existing keys from BigQuery (date-filtered, Storage Read API).", flush=True)
+            return keys
+        except Exception as e:
+            print(f"[WARN] Storage Read API unavailable ({e}), falling back to query.", flush=True)
+        query = f"SELECT unique_key FROM `{BQ_PROJECT}.{BQ_DATASET}.{BQ_TABLE}` WHERE Date BETWEEN @start_date AND @end_date"
+        job_config = bigquery.QueryJobConfig(query_parameters=date_window_params(start_date, end_date))
+        with warnings.catch_warnings():
+            warnings.simplefilter("ignore")
+            # Arrow result: the column stays one string buffer, no pandas object array in between
+            keys = bq_client.query(query, job_config=job_config).result().to_arrow().column("unique_key").to_pylist()
+        print(f"[INFO] Retrieved {len(keys)} existing keys from BigQuery (date-filtered).", flush=True)
+        return ExistingKeySet(keys)
     except Exception as e:
         print(f"[WARN] Failed to fetch existing keys: {e}", flush=True)
-        return set()
+        return ExistingKeySet()
 
 # ---------- UPLOAD TO BIGQUERY ----------
+UPLOAD_SCHEMA = [
+    bigquery.SchemaField("Date", "DATE"),
+    bigquery.SchemaField("Query", "STRING"),
+    bigquery.SchemaField("Page", "STRING"),
+    bigquery.SchemaField("Country", "STRING"),
+    bigquery.SchemaField("Device", "STRING"),
+    bigquery.SchemaField("SearchAppearance", "STRING"),
+    bigquery.SchemaField("Clicks", "INTEGER"),
+    bigquery.SchemaField("Impressions", "INTEGER"),
+    bigquery.SchemaField("CTR", "FLOAT"),
+    bigquery.SchemaField("Position", "FLOAT"),
+    bigquery.SchemaField("SearchType", "STRING"),
+    bigquery.SchemaField("unique_key", "STRING"),
+]
+
+def to_date_column(dates):
+    """
+    GSC's 'YYYY-MM-DD' strings -> datetime64 column with one Arrow string->date32 cast over the
+    whole batch instead of pd.to_datetime's format inference; anything else falls back to pd.to_datetime.
+    """
+    if pd.api.types.is_datetime64_any_dtype(dates):
+        return dates
+    try:
+        days = pa.array(dates, type=pa.string()).cast(pa.date32())
+    except (pa.ArrowInvalid, pa.ArrowTypeError):
+        return pd.to_datetime(dates)
+    return pd.Series(days.to_numpy(zero_copy_only=False).astype("datetime64[s]"), index=dates.index, name=dates.name)
+
 def upload_to_bq(df):
     if df.empty:
         print("[INFO] No new rows to insert.", flush=True)
         return 0
-    df["Date"] = pd.to_datetime(df["Date"])
+    df["Date"] = to_date_column(df["Date"])
     if DEBUG_MODE:
         print(f"[DEBUG] Debug mode ON: skipping insert of {len(df)} rows to BigQuery", flush=True)
         return len(df)
-    job_config = bigquery.LoadJobConfig(
-        write_disposition="WRITE_APPEND",
-        schema=[
-            bigquery.SchemaField("Date", "DATE"),
-            bigquery.SchemaField("Query", "STRING"),
-            bigquery.SchemaField("Page", "STRING"),
-            bigquery.SchemaField("Country", "STRING"),
-            bigquery.SchemaField("Device", "STRING"),
-            bigquery.SchemaField("SearchAppearance", "STRING"),
-            bigquery.SchemaField("Clicks", "INTEGER"),
-            bigquery.SchemaField("Impressions", "INTEGER"),
-            bigquery.SchemaField("CTR", "FLOAT"),
-            bigquery.SchemaField("Position", "FLOAT"),
-            bigquery.SchemaField("SearchType", "STRING"),
-            bigquery.SchemaField("unique_key", "STRING"),
-        ],
-    )
+    appended = 0
+    if append_dataframe is not None:
+        # Storage Write API (_default stream): one gRPC append per ~5 MB instead of a load job per page,
+        # so per-page uploads no longer count against the table's daily load-job quota
+        try:
+            inserted = append_dataframe(upload_ref, UPLOAD_SCHEMA, df, credentials=get_credentials())
+            print(f"[INFO] Inserted {inserted} rows to BigQuery.", flush=True)
+            return inserted
+        except AppendRowsError as e:
+            # the other requests are committed: only the failed rows go to the load-job spool
+            print(f"[WARN] Storage Write API append failed ({e}); queueing those rows for the load job.", flush=True)
+            appended = len(df) - len(e.failed_rows)
+            df = df.iloc[e.failed_rows]
+        except Exception as e:
+            print(f"[WARN] Storage Write API append failed ({e}); queueing {len(df)} rows for the load job.", flush=True)
+    # no Storage Write API, or an append failed: the page's keys are already in existing_keys, so its rows
+    # must not be dropped; queue them in the run's Parquet spool and flush_upload_spool() loads it with one job
+    # (queued rows are not counted here: main adds what the load job actually wrote)
+    spool_rows(df)
+    print(f"[INFO] Queued {len(df)} rows for the end-of-run BigQuery load.", flush=True)
+    return appended
+
+# ---------- LOAD-JOB FALLBACK: one Parquet spool file per run ----------
+# one load job at the end instead of load_table_from_dataframe per page (daily load-job quota, job latency)
+SPOOL_PATH = os.path.join(tempfile.gettempdir(), f"{BQ_TABLE}_{os.getpid()}.parquet")
+SPOOL_SCHEMA = pa.schema([
+    (f.name, {"DATE": pa.date32(), "INTEGER": pa.int64(), "FLOAT": pa.float64()}.get(f.field_type, pa.string()))
+    for f in UPLOAD_SCHEMA
+])
+_spool_writer = None
+_spool_rows = 0
+
+def spool_rows(df):
+    global _spool_writer, _spool_rows
+    if _spool_writer is None:
+        _spool_writer = pq.ParquetWriter(SPOOL_PATH, SPOOL_SCHEMA, compression="zstd")
+    frame = df[SPOOL_SCHEMA.names].assign(Date=pd.to_datetime(df["Date"]).dt.date)
+    _spool_writer.write_table(pa.Table.from_pandas(frame, schema=SPOOL_SCHEMA, preserve_index=False))
+    _spool_rows += len(df)
+
+def flush_upload_spool():
+    """
+    Load everything queued by upload_to_bq's fallback path (no Write API, or failed appends) with a single
+    Parquet load job; spools of GCS_STAGING_MIN_BYTES or more go through GCS_STAGING_BUCKET when it is set.
+    """
+    global _spool_writer, _spool_rows
+    if _spool_writer is None:
+        return 0
+    _spool_writer.close()
+    _spool_writer = None
+    n_rows, _spool_rows = _spool_rows, 0
     try:
-        job = bq_client.load_table_from_dataframe(df, table_ref, job_config=job_config)
-        job.result()
-        print(f"[INFO] Inserted {len(df)} rows to BigQuery.", flush=True)
-        return len(df)
+        job_config = bigquery.LoadJobConfig(
+            source_format=bigquery.SourceFormat.PARQUET,
+            write_disposition="WRITE_APPEND",
+            schema=UPLOAD_SCHEMA,
+        )
+        staged = False
+        if GCS_STAGING_BUCKET and storage is not None and os.path.getsize(SPOOL_PATH) >= GCS_STAGING_MIN_BYTES:
+            try:
+                load_spool_via_gcs(job_config)
+                staged = True
+            except Exception as e:
+                # the spool file is still on disk: load it directly rather than losing the queued rows
+                print(f"[WARN] GCS staging failed ({e}); loading the spool file directly.", flush=True)
+        if not staged:
+            with open(SPOOL_PATH, "rb") as f:
+                bq_client.load_table_from_file(f, upload_ref, job_config=job_config).result()
+        print(f"[INFO] Inserted {n_rows} queued rows to BigQuery (single load job).", flush=True)
+        return n_rows
     except Exception as e:
-        print(f"[ERROR] Failed to insert rows: {e}", flush=True)
+        print(f"[ERROR] Failed to load {n_rows} queued rows: {e}", flush=True)
         return 0
+    finally:
+        os.remove(SPOOL_PATH)
+
+def load_spool_via_gcs(job_config):
+    """
+    Upload the spool file to GCS_STAGING_BUCKET (resumable, 256 MB chunks), load it with
+    load_table_from_uri (GCS -> BigQuery stays inside Google's network), then delete the blob.
+    """
+    bucket = storage.Client(credentials=get_credentials(), project=bq_client.project).bucket(GCS_STAGING_BUCKET)
+    blob = bucket.blob(f"gsc_tmp/{os.path.basename(SPOOL_PATH)}", chunk_size=256 * 1024 * 1024)
+    blob.upload_from_filename(SPOOL_PATH, timeout=None)
+    print(f"[INFO] Staged spool file at gs://{GCS_STAGING_BUCKET}/{blob.name}", flush=True)
+    try:
+        bq_client.load_table_from_uri(f"gs://{GCS_STAGING_BUCKET}/{blob.name}", upload_ref, job_config=job_config).result()
+    finally:
+        blob.delete()
+
+# ---------- SERVER-SIDE DEDUP (--server-dedup) ----------
+def create_staging_table():
+    table = bigquery.Table(staging_ref, schema=UPLOAD_SCHEMA)
+    table.expires = datetime.utcnow() + timedelta(days=1)  # a staging table left by a failed run cleans itself up
+    bq_client.create_table(table, exists_ok=True)
+    print(f"[INFO] Staging table {staging_ref.table_id} ready.", flush=True)
+
+def merge_staging_table():
+    """
+    Anti-join in BigQuery: insert the staged rows whose unique_key is not in the target yet, then drop
+    the staging table. Replaces the client-side existing-keys download; returns the rows merged.
+    """
+    cols = ", ".join(f.name for f in UPLOAD_SCHEMA)
+    merge_sql = f"""
+        MERGE `{BQ_PROJECT}.{BQ_DATASET}.{BQ_TABLE}` T
+        USING `{BQ_PROJECT}.{BQ_DATASET}.{staging_ref.table_id}` S
+        ON T.unique_key = S.unique_key AND T.Date BETWEEN @start_date AND @end_date
+        WHEN NOT MATCHED THEN INSERT ({cols}) VALUES ({cols})
+    """
+    try:
+        merge_job = bq_client.query(merge_sql, job_config=bigquery.QueryJobConfig(query_parameters=date_window_params(START_DATE, END_DATE)))
+        merge_job.result()
+    except Exception as e:
+        print(f"[ERROR] Failed to merge staging table {staging_ref.table_id} (kept for 1 day): {e}", flush=True)
+        return 0
+    inserted = merge_job.num_dml_affected_rows or 0
+    print(f"[INFO] Server-side dedup: merged {inserted} new rows into {BQ_TABLE}.", flush=True)
+    bq_client.delete_table(staging_ref, not_found_ok=True)
+    return inserted
+
+# ---------- HELPER: GSC rows -> DataFrame ----------
+@functools.lru_cache(maxsize=None)
+def dim_index_map(dims):
+    """
+    {lowercase dimension name: position in r["keys"]} for one dims tuple (first occurrence wins,
+    like list.index). Built once per dimension batch, not per page or row.
+    """
+    dims_list = [str(d).lower() for d in dims]
+    return {name: dims_list.index(name) for name in dims_list}
+
+def gsc_rows_to_frame(rows, dim_index, default_date, search_type):
+    """
+    One GSC page as a DataFrame built column-by-column (one list per column) instead of a dict per row.
+    Same values as the per-row code: missing Date -> default_date, missing Query -> "",
+    missing/blank Page/Country/Device -> __NO_PAGE__/__NO_COUNTRY__/__NO_DEVICE__ (others stripped).
+    """
+    keys = [r.get("keys", []) for r in rows]
+
+    def dim_values(name):
+        j = dim_index.get(name)
+        if j is None:
+            return [None] * len(rows)
+        return [k[j] if len(k) > j else None for k in keys]
+
+    def with_placeholder(name, placeholder):
+        vals = pd.Series(dim_values(name), dtype=object).fillna("").astype(str).str.strip()
+        return vals.mask(vals == "", placeholder)
+
+    return pd.DataFrame({
+        "Date": [d or default_date for d in dim_values("date")],
+        "Query": [q or "" for q in dim_values("query")],
+        "Page": with_placeholder("page", "__NO_PAGE__"),
+        "Country": with_placeholder("country", "__NO_COUNTRY__"),
+        "Device": with_placeholder("device", "__NO_DEVICE__"),
+        "SearchAppearance": "__NO_APPEARANCE__",
+        "Clicks": [r.get("clicks", 0) for r in rows],
+        "Impressions": [r.get("impressions", 0) for r in rows],
+        "CTR": [r.get("ctr", 0.0) for r in rows],
+        "Position": [r.get("position", 0.0) for r in rows],
+        "SearchType": search_type,
+    })
+
+def noindex_page_frame(rows, search_type):
+    """
+    Rows of one ['date','page'] page whose page key is NULL/blank, as a __NO_INDEX__ DataFrame
+    built column-wise (one list per column) instead of a dict per row.
+    """
+    blank = [r for r in rows if len(r.get("keys", [])) == 2 and (r["keys"][1] is None or str(r["keys"][1]).strip() == "")]
+    return pd.DataFrame({
+        "Date": [r["keys"][0] for r in blank],
+        "Query": "__NO_INDEX__",
+        "Page": "__NO_INDEX__",
+        "Country": "__NO_COUNTRY__",
+        "Device": "__NO_DEVICE__",
+        "SearchAppearance": "__NO_APPEARANCE__",
+        "Clicks": [r.get("clicks", 0) for r in blank],
+        "Impressions": [r.get("impressions", 0) for r in blank],
+        "CTR": [r.get("ctr", 0.0) for r in blank],
+        "Position": [r.get("position", 0.0) for r in blank],
+        "SearchType": search_type,
+    }, index=pd.RangeIndex(len(blank)))
+
+def page_total_frame(rows, search_type):
+    """
+    Rows of one ['date','page'] page with a non-empty page key, as a __PAGE_TOTAL__ DataFrame built
+    column-wise. GSC returns 'date' as a YYYY-MM-DD str, so Date is taken as-is; key normalization
+    (date slice, page strip/lower/rstrip) happens once per column in generate_expanded_unique_keys.
+    """
+    pages = [r for r in rows if len(r.get("keys", [])) == 2 and r["keys"][1]]
+    return pd.DataFrame({
+        "Date": [r["keys"][0] for r in pages],
+        "Query": "__PAGE_TOTAL__",
+        "Page": [r["keys"][1] for r in pages],
+        "Country": "__NO_COUNTRY__",
+        "Device": "__NO_DEVICE__",
+        "SearchAppearance": "__NO_APPEARANCE__",
+        "Clicks": [r.get("clicks", 0) for r in pages],
+        "Impressions": [r.get("impressions", 0) for r in pages],
+        "CTR": [r.get("ctr", 0.0) for r in pages],
+        "Position": [r.get("position", 0.0) for r in pages],
+        "SearchType": search_type,
+    }, index=pd.RangeIndex(len(pages)))
+
+def sitewide_page_frame(rows, search_type):
+    """One ['date'] page as a __SITE_TOTAL__ DataFrame built column-wise (missing date key -> None)."""
+    return pd.DataFrame({
+        "Date": [(r.get("keys") or [None])[0] for r in rows],
+        "Query": "__SITE_TOTAL__",
+        "Page": "__SITE_TOTAL__",
+        "Country": "__NO_COUNTRY__",
+        "Device": "__NO_DEVICE__",
+        "SearchAppearance": "__NO_APPEARANCE__",
+        "Clicks": [r.get("clicks", 0) for r in rows],
+        "Impressions": [r.get("impressions", 0) for r in rows],
+        "CTR": [r.get("ctr", 0.0) for r in rows],
+        "Position": [r.get("position", 0.0) for r in rows],
+        "SearchType": search_type,
+    }, index=pd.RangeIndex(len(rows)))
+
+# ---------- FETCH ONE GSC PAGE (thread-safe) ----------
+# one pooled keep-alive HTTPS session shared by all worker threads (urllib3's pool is thread-safe):
+# the TLS handshake and OAuth token refresh are paid once per connection instead of per page
+GSC_QUERY_URL = f"https://searchconsole.googleapis.com/webmasters/v3/sites/{quote(SITE_URL, safe='')}/searchAnalytics/query"
+gsc_session = AuthorizedSession(get_credentials())
+# transient failures (429/5xx, dropped connections, timeouts) are retried by urllib3 with exponential
+# backoff and Retry-After; anything else, or still failing after GSC_NUM_RETRIES, raises to the caller
+GSC_RETRY = Retry(
+    total=GSC_NUM_RETRIES,
+    backoff_factor=2,
+    status_forcelist=(429, 500, 502, 503, 504),
+    allowed_methods=None,  # searchAnalytics.query is a read-only POST
+    respect_retry_after_header=True,
+    raise_on_status=False,
+)
+gsc_session.mount("https://", HTTPAdapter(pool_connections=1, pool_maxsize=FETCH_WORKERS, max_retries=GSC_RETRY))
+
+def fetch_gsc_page(request):
+    resp = gsc_session.post(GSC_QUERY_URL, params={"fields": GSC_FIELDS}, json=request, timeout=HTTP_TIMEOUT)
+    resp.raise_for_status()
+    payload = orjson.loads(resp.content) if orjson is not None else resp.json()
+    return payload.get("rows", [])
+
+def submit_page_group(pool, request, start_row):
+    """Request PREFETCH_PAGES consecutive pages of `request` concurrently; [(offset, future), ...] in startRow order."""
+    return [
+        (offset, pool.submit(fetch_gsc_page, dict(request, startRow=offset)))
+        for offset in (start_row + k * ROW_LIMIT for k in range(PREFETCH_PAGES))
+    ]
+
+def iter_gsc_pages(request):
+    """
+    Page through one query for the single-query passes (No-Index, Batch 7, sitewide) over the same
+    session, retries and submit_page_group as the main batches; stops after the first empty or short page.
+    """
+    pool = ThreadPoolExecutor(max_workers=PREFETCH_PAGES)
+    try:
+        start_row = 0
+        while True:
+            for offset, future in submit_page_group(pool, request, start_row):
+                rows = future.result()
+                if not rows:
+                    return
+                yield rows
+                if len(rows) < ROW_LIMIT:
+                    return
+            start_row += PREFETCH_PAGES * ROW_LIMIT
+    finally:
+        pool.shutdown(wait=False, cancel_futures=True)
 
 # ---------- FETCH GSC DATA ----------
 def fetch_gsc_data(start_date, end_date, existing_keys):
@@ -253,9 +558,11 @@ def fetch_gsc_data(start_date, end_date, existing_keys):
     Pagination is handled per (dims, searchType) with start_row reset for each pair.
     Returns (df_all_new, total_inserted)
     """
-    service = get_gsc_service()
-    all_new_rows = []
+    all_new_frames = []
     total_inserted = 0
+    pool = ThreadPoolExecutor(max_workers=FETCH_WORKERS)
+    upload_pool = ThreadPoolExecutor(max_workers=1)  # one writer: BQ appends stay serialized
+    pending_uploads = []
 
     DIMENSION_BATCHES = [
         ["date", "query", "page", "country", "device"],
@@ -265,158 +572,120 @@ def fetch_gsc_data(start_date, end_date, existing_keys):
         ["date", "query"],
     ]
 
+    def batch_request(dims, stype):
+        return {"startDate": start_date, "endDate": end_date, "dimensions": dims, "rowLimit": ROW_LIMIT, "searchType": stype}
+
     total_fetched_overall = 0
     total_new_candidates_overall = 0
 
+    # (dims, searchType) pairs are independent on the GSC side: the first page groups of the next
+    # BATCH_LOOKAHEAD pairs are already in flight while the current one pages (FETCH_WORKERS has a
+    # thread for each, so the current pair's own next group never queues behind them). Pages are still
+    # consumed pair by pair in the original order, so the first-occurrence-wins duplicate check sees
+    # the same sequence as before; memory is bounded by the pages of the in-flight groups.
+    pairs = [(dims, stype) for dims in DIMENSION_BATCHES for stype in SEARCH_TYPES]
+    pair_index = 0
+    lookahead = deque(submit_page_group(pool, batch_request(*pair), 0) for pair in pairs[:1 + BATCH_LOOKAHEAD])
+
     for i, dims in enumerate(DIMENSION_BATCHES, start=1):
         fetched_total_for_batch = 0
         new_candidates_for_batch = 0
+        # dims are fixed for the whole batch: normalize them and resolve the key positions once
+        dims_list = [d.lower() for d in dims] if isinstance(dims, list) else [str(dims).lower()]
+        dim_index = dim_index_map(tuple(dims_list))
+        has_country = "country" in dim_index
 
         for stype in SEARCH_TYPES:
+            group = lookahead.popleft()
+            pair_index += 1
+            if pair_index + BATCH_LOOKAHEAD < len(pairs):
+                lookahead.append(submit_page_group(pool, batch_request(*pairs[pair_index + BATCH_LOOKAHEAD]), 0))
+
             # reset pagination per (dims, stype)
             start_row = 0
             page_index = 0
             print(f"[INFO] Batch {i}, dims={dims}, starting fetch for SearchType={stype}", flush=True)
 
-            while True:
-                request = {
-                    "startDate": start_date,
-                    "endDate": end_date,
-                    "dimensions": dims,
-                    "rowLimit": ROW_LIMIT,
-                    "startRow": start_row,
-                    "searchType": stype,
-                }
-
-                try:
-                    resp = service.searchanalytics().query(siteUrl=SITE_URL, body=request).execute()
-                except Exception as e:
-                    print(f"[ERROR] Timeout or GSC error for dims={dims}, stype={stype}: {e}. Retrying in {RETRY_DELAY}s...", flush=True)
-                    time.sleep(RETRY_DELAY)
-                    continue
-
-                rows = resp.get("rows", [])
-                if not rows:
-                    print(f"[INFO] No rows returned for dims={dims}, stype={stype}, startRow={start_row}", flush=True)
-                    break  # no more rows for this (dims,stype)
-
-                fetched_count = len(rows)
-                fetched_total_for_batch += fetched_count
-                page_index += 1
-
-                batch_new = []
-                # ---------- REPLACE the inner loop body with this (inside fetch_gsc_data) ----------
-                for r in rows:
-                    # build dims_list normalized (lowercase names)
-                    if isinstance(dims, list):
-                        dims_list = [d.lower() for d in dims]
-                    else:
-                        dims_list = [str(dims).lower()]
-
-                    # map keys returned by GSC to dimension names (keys align left)
-                    # e.g., dims_list = ['date','query','page','country','device']
-                    keys = r.get("keys", [])
-                    keys_dict = dict(zip(dims_list, keys))
-
-                    # safe extraction: use keys_dict and normalize to expected capitalized column names
-                    date = keys_dict.get("date") or start_date
-                    query = keys_dict.get("query") or None
-                    page = keys_dict.get("page") or None
-                    country = keys_dict.get("country") or None
-                    device = keys_dict.get("device") or None
-
-                    # ensure placeholders for missing dims so unique-key sees consistent fields
-                    # (you can tweak placeholders if you prefer other tokens)
-                    if page is None or str(page).strip() == "":
-                        page_val = "__NO_PAGE__"
-                    else:
-                        page_val = str(page).strip()
-
-                    if country is None or str(country).strip() == "":
-                        country_val = "__NO_COUNTRY__"
-                    else:
-                        country_val = str(country).strip()
-
-                    if device is None or str(device).strip() == "":
-                        device_val = "__NO_DEVICE__"
-                    else:
-                        device_val = str(device).strip()
-
-                    # build row with same column names used elsewhere in pipeline
-                    row = {
-                        "Date": date,
-                        "Query": query if query is not None else "",
-                        "Page": page_val,
-                        "Country": country_val,
-                        "Device": device_val,
-                        "SearchAppearance": "__NO_APPEARANCE__",
-                        "Clicks": r.get("clicks", 0),
-                        "Impressions": r.get("impressions", 0),
-                        "CTR": r.get("ctr", 0.0),
-                        "Position": r.get("position", 0.0),
-                        "SearchType": stype,
-                    }
-
-                    # generate unique key once using the dims list (pass dims_list so function knows which dims to use)
-                    unique_key = generate_expanded_unique_key(row, dims_list)
-
-                    # ---------- DEBUG: print the actual values used to build the key ----------
-                    # show a compact mapping so you can verify per-row which fields were used
-    #                debug_map = {d: row.get(d.capitalize() if d != 'query' else 'Query') for d in dims_list}
-    #                print("DEBUG key_fields:", debug_map, " -> unique_key:", unique_key, flush=True)
-
-                    # duplicate check
-                    if unique_key not in existing_keys:
-                        existing_keys.add(unique_key)
-                        row["unique_key"] = unique_key
-                        batch_new.append(row)
-
-                new_candidates_for_batch += len(batch_new)
-                print(f"[INFO] Batch {i} (page {page_index}): Fetched {len(rows)} rows, {len(batch_new)} new rows.", flush=True)
+            done = False
+            while not done:
+                # request the next PREFETCH_PAGES pages concurrently; results are processed in startRow order
+                if group is None:
+                    group = submit_page_group(pool, batch_request(dims, stype), start_row)
+                for offset, rows in ((offset, future.result()) for offset, future in group):
+                    if not rows:
+                        print(f"[INFO] No rows returned for dims={dims}, stype={stype}, startRow={offset}", flush=True)
+                        done = True
+                        break  # no more rows for this (dims,stype)
+
+                    fetched_count = len(rows)
+                    fetched_total_for_batch += fetched_count
+                    page_index += 1
+
+                    # build the page column-wise and generate unique keys for the whole page at once
+                    page_df = gsc_rows_to_frame(rows, dim_index, start_date, stype)
+                    page_df["unique_key"] = generate_expanded_unique_keys(page_df, dims_list)
+
+                    # duplicate check (in page order, so the first occurrence wins as before), one vectorized pass per page
+                    is_new = existing_keys.add_new(page_df["unique_key"])
+                    batch_new = page_df[is_new]
+
+                    new_candidates_for_batch += len(batch_new)
+                    print(f"[INFO] Batch {i} (page {page_index}): Fetched {len(rows)} rows, {len(batch_new)} new rows.", flush=True)
                 
-                if batch_new:
-                    df_batch = pd.DataFrame(batch_new)
-
-                    # ---------- APPLY COUNTRY MAPPING FOR THIS BATCH (if applicable) ----------
-                    # only attempt mapping for batches that requested the 'country' dimension
-                    if "country" in [d.lower() for d in dims]:
-                        # find actual country column name in df_batch (case-insensitive)
-                        country_col = next((c for c in df_batch.columns if c.lower() == "country"), None)
-
-                        if country_col is None:
-                            print(f"[DEBUG] Batch {i}: expected 'country' column but none found in columns. Skipping country mapping.", flush=True)
-                        else:
-                            # quick samples to inspect incoming codes
-                            sample_vals = pd.Series(df_batch[country_col].astype(str)).dropna().unique()[:20]
-
-                            # apply robust mapping (uses utils.robust_map_country_column)
-                            df_batch = robust_map_country_column(df_batch, country_col=country_col, country_map=COUNTRY_MAP, new_col="Country")
-                            # now show how many mapped / unmapped
-                            mapped_count = df_batch["Country"].notna().sum()
-                            total_count = len(df_batch)
-
-                    # ---------- UPLOAD to BQ ----------
-                    inserted = upload_to_bq(df_batch)
-                    total_inserted += inserted
-                    all_new_rows.extend(batch_new)
-
-                # pagination control:
-                # if rows < ROW_LIMIT -> no further pages for this (dims, stype)
-                if fetched_count < ROW_LIMIT:
-                    print(f"[INFO] End of pages for dims={dims}, stype={stype} (fetched_count={fetched_count} < ROW_LIMIT)", flush=True)
-                    break
-                # else increment start_row and continue
-                start_row += fetched_count
-                # safety guard to avoid runaway loops: break if too many pages (e.g., >1000)
-                if page_index > 10000:
-                    print(f"[WARN] Too many pages for dims={dims}, stype={stype}. Breaking to avoid infinite loop.", flush=True)
-                    break
+                    if not batch_new.empty:
+                        df_batch = batch_new.copy()
+
+                        # ---------- APPLY COUNTRY MAPPING FOR THIS BATCH (if applicable) ----------
+                        # only attempt mapping for batches that requested the 'country' dimension
+                        if has_country:
+                            # find actual country column name in df_batch (case-insensitive)
+                            country_col = next((c for c in df_batch.columns if c.lower() == "country"), None)
+
+                            if country_col is None:
+                                print(f"[DEBUG] Batch {i}: expected 'country' column but none found in columns. Skipping country mapping.", flush=True)
+                            else:
+                                # quick samples to inspect incoming codes
+                                sample_vals = pd.Series(df_batch[country_col].astype(str)).dropna().unique()[:20]
+
+                                # apply robust mapping (uses utils.robust_map_country_column)
+                                df_batch = robust_map_country_column(df_batch, country_col=country_col, country_map=COUNTRY_MAP, new_col="Country")
+                                # now show how many mapped / unmapped
+                                mapped_count = df_batch["Country"].notna().sum()
+                                total_count = len(df_batch)
+
+                        # ---------- UPLOAD to BQ (background) ----------
+                        # the upload runs on its own thread while the next pages are fetched and hashed;
+                        # at most MAX_PENDING_UPLOADS batches wait in memory, older ones are collected first
+                        pending_uploads.append(upload_pool.submit(upload_to_bq, df_batch))
+                        while len(pending_uploads) > MAX_PENDING_UPLOADS:
+                            total_inserted += pending_uploads.pop(0).result()
+                        # only the --csv-test output reads the run's rows back; otherwise uploaded pages are not kept
+                        if CSV_TEST_FILE:
+                            all_new_frames.append(batch_new)
+
+                    # pagination control:
+                    # if rows < ROW_LIMIT -> no further pages for this (dims, stype)
+                    if fetched_count < ROW_LIMIT:
+                        print(f"[INFO] End of pages for dims={dims}, stype={stype} (fetched_count={fetched_count} < ROW_LIMIT)", flush=True)
+                        done = True
+                        break
+                    # else increment start_row and continue
+                    start_row += fetched_count
+                    # safety guard to avoid runaway loops: break if too many pages (e.g., >1000)
+                    if page_index > 10000:
+                        print(f"[WARN] Too many pages for dims={dims}, stype={stype}. Breaking to avoid infinite loop.", flush=True)
+                        done = True
+                        break
+                group = None
 
         print(f"[INFO] Batch {i} summary: fetched_total={fetched_total_for_batch}, new_candidates={new_candidates_for_batch}", flush=True)
         total_fetched_overall += fetched_total_for_batch
         total_new_candidates_overall += new_candidates_for_batch
 
-    df_all_new = pd.DataFrame(all_new_rows)
+    pool.shutdown(wait=False, cancel_futures=True)
+    total_inserted += sum(f.result() for f in pending_uploads)
+    upload_pool.shutdown()
+    df_all_new = pd.concat(all_new_frames, ignore_index=True) if all_new_frames else pd.DataFrame()
     print(f"[INFO] Fetch_GSC_Data summary: fetched_overall={total_fetched_overall}, new_candidates_overall={total_new_candidates_overall}, inserted_overall={total_inserted}", flush=True)
     return df_all_new, total_inserted
 
@@ -426,8 +695,7 @@ def fetch_noindex_batch(start_date, end_date, existing_keys):
     Fetch rows where 'page' is NULL/empty in dimensions ['date','page'].
     Returns (df_noindex, inserted_count)
     """
-    service = get_gsc_service()
-    noindex_rows = []
+    noindex_frames = []
     inserted_total = 0
     fetched_total = 0
     new_candidates = 0
@@ -435,62 +703,26 @@ def fetch_noindex_batch(start_date, end_date, existing_keys):
     dims_for_batch = ["date", "page"]  # ✅ مهم: هم‌راستا با dimensions درخواست API
 
     for stype in SEARCH_TYPES:
-        start_row = 0
-        while True:
-            print(f"[INFO] Batch 6, No-Index fetch for stype={stype}, startRow={start_row}", flush=True)
-            request = {
-                "startDate": start_date,
-                "endDate": end_date,
-                "dimensions": dims_for_batch,
-                "rowLimit": ROW_LIMIT,
-                "startRow": start_row,
-                "searchType": stype,
-            }
-            try:
-                resp = service.searchanalytics().query(siteUrl=SITE_URL, body=request).execute()
-            except Exception as e:
-                print(f"[ERROR] Batch 6, No-Index fetch error for stype={stype}: {e}, retrying in {RETRY_DELAY} sec...", flush=True)
-                time.sleep(RETRY_DELAY)
-                continue
-
-            rows = resp.get("rows", [])
-            if not rows:
-                break
-
+        print(f"[INFO] Batch 6, No-Index fetch for stype={stype}", flush=True)
+        request = {
+            "startDate": start_date,
+            "endDate": end_date,
+            "dimensions": dims_for_batch,
+            "rowLimit": ROW_LIMIT,
+            "searchType": stype,
+        }
+        # PREFETCH_PAGES pages at a time over the shared GSC session; stops after the last (short) page
+        for rows in iter_gsc_pages(request):
             fetched_total += len(rows)
-            for r in rows:
-                keys = r.get("keys", [])
-                # expect [date, page]
-                if len(keys) == 2:
-                    page_val = keys[1]
-                    if (page_val is None) or (str(page_val).strip() == ""):
-                        row = {
-                            "Date": keys[0],
-                            "Query": "__NO_INDEX__",
-                            "Page": "__NO_INDEX__",
-                            "Country": "__NO_COUNTRY__",
-                            "Device": "__NO_DEVICE__",
-                            "SearchAppearance": "__NO_APPEARANCE__",
-                            "Clicks": r.get("clicks", 0),
-                            "Impressions": r.get("impressions", 0),
-                            "CTR": r.get("ctr", 0.0),
-                            "Position": r.get("position", 0.0),
-                            "SearchType": stype,
-                        }
-
-                        # ✅ استفاده از مکانیزم جدید کلید یکتا در فضای ابعاد گسترش‌یافته
-                        row["unique_key"] = generate_expanded_unique_key(row, dims_for_batch)
-
-                        if row["unique_key"] not in existing_keys:
-                            existing_keys.add(row["unique_key"])
-                            noindex_rows.append(row)
-                            new_candidates += 1
-
-            if len(rows) < ROW_LIMIT:
-                break
-            start_row += len(rows)
-
-    df_noindex = pd.DataFrame(noindex_rows) if noindex_rows else pd.DataFrame([])
+            page_df = noindex_page_frame(rows, stype)
+            if not page_df.empty:
+                # ✅ استفاده از مکانیزم جدید کلید یکتا در فضای ابعاد گسترش‌یافته
+                page_df["unique_key"] = generate_expanded_unique_keys(page_df, dims_for_batch)
+                is_new = existing_keys.add_new(page_df["unique_key"])
+                noindex_frames.append(page_df[is_new])
+                new_candidates += int(is_new.sum())
+
+    df_noindex = pd.concat(noindex_frames, ignore_index=True) if noindex_frames else pd.DataFrame([])
     if not df_noindex.empty:
         inserted = upload_to_bq(df_noindex)
         inserted_total += inserted
@@ -504,154 +736,73 @@ def fetch_noindex_batch(start_date, end_date, existing_keys):
 def fetch_sitewide_batch(start_date, end_date, existing_keys):
     """
     Sitewide: dimensions = ['date']
-    Inserts __SITE_TOTAL__ rows per searchType and placeholder dates for missing days.
+    Inserts __SITE_TOTAL__ rows per searchType; dates GSC has no data for yet are only logged.
     Returns (df_all_new_rows, inserted_count)
     """
     print("[INFO] Batch 8: Running sitewide ['date']...", flush=True)
-    service = get_gsc_service()
-    all_new_rows = []
+    new_frames = []
     total_new_count = 0
 
-    # ---------- Step 0: load existing unique_keys from BigQuery ----------
-    def get_existing_sitewide_keys(start_date, end_date, project_id, dataset_id, table_name):
-        client = bigquery.Client()
-        full_table_id = f"{project_id}.{dataset_id}.{table_name}"
-        query = f"""
-            SELECT unique_key
-            FROM `{full_table_id}`
-            WHERE Date BETWEEN '{start_date}' AND '{end_date}'
-              AND Query='__SITE_TOTAL__'
-              AND Page='__SITE_TOTAL__'
-        """
-        query_job = client.query(query)
-        result = query_job.result()
-        return set(row.unique_key for row in result)
-
-    existing_bq_keys = get_existing_sitewide_keys(START_DATE, END_DATE, BQ_PROJECT, BQ_DATASET, BQ_TABLE)
-
     # ---------- Step 1: fetch actual GSC rows for ['date'] ----------
     dims_for_batch = ["date"]  # ✅ کلید اصلی ابعاد این Batch
-    start_row = 0
     batch_index = 1
     fetched_total = 0
     new_candidates = 0
+    fetched_dates = set()
 
     for stype in SEARCH_TYPES:
-        start_row = 0
-        while True:
-            print(f"[INFO] Batch 8: Sitewide fetch for stype={stype}, startRow={start_row}", flush=True)
-            request = {
-                "startDate": start_date,
-                "endDate": end_date,
-                "dimensions": dims_for_batch,
-                "rowLimit": ROW_LIMIT,
-                "startRow": start_row,
-                "searchType": stype,
-            }
-            try:
-                resp = service.searchanalytics().query(siteUrl=SITE_URL, body=request).execute()
-            except Exception as e:
-                print(f"[ERROR] Batch 8: Sitewide error (stype={stype}): {e}, retrying in {RETRY_DELAY} sec...", flush=True)
-                time.sleep(RETRY_DELAY)
-                continue
-
-            rows = resp.get("rows", [])
-            if not rows:
-                break
-
+        print(f"[INFO] Batch 8: Sitewide fetch for stype={stype}", flush=True)
+        request = {
+            "startDate": start_date,
+            "endDate": end_date,
+            "dimensions": dims_for_batch,
+            "rowLimit": ROW_LIMIT,
+            "searchType": stype,
+        }
+        # PREFETCH_PAGES pages at a time over the shared GSC session; stops after the last (short) page
+        for rows in iter_gsc_pages(request):
             fetched_total += len(rows)
-            batch_new = []
-
-            for r in rows:
-                keys = r.get("keys", [])
-                date = keys[0] if len(keys) > 0 else None
-
-                row = {
-                    "Date": date,
-                    "Query": "__SITE_TOTAL__",
-                    "Page": "__SITE_TOTAL__",
-                    "Country": "__NO_COUNTRY__",
-                    "Device": "__NO_DEVICE__",
-                    "SearchAppearance": "__NO_APPEARANCE__",
-                    "Clicks": r.get("clicks", 0),
-                    "Impressions": r.get("impressions", 0),
-                    "CTR": r.get("ctr", 0.0),
-                    "Position": r.get("position", 0.0),
-                    "SearchType": stype,
-                }
-
-                # ✅ ایجاد کلید یکتا بر اساس ابعاد Batch
-                row["unique_key"] = generate_expanded_unique_key(row, dims_for_batch)
-
-                # ---------- Upsert logic ----------
-                if row["unique_key"] in existing_bq_keys:
-                    # در این نسخه فقط لاگ ثبت می‌کنیم؛ در آینده میشه UPDATE کرد
-                    print(f"[INFO] Row for {date} already exists → skip (update not implemented)", flush=True)
-                elif row["unique_key"] not in existing_keys:
-                    existing_keys.add(row["unique_key"])
-                    batch_new.append(row)
-                    new_candidates += 1
+
+            # ✅ ایجاد کلید یکتا بر اساس ابعاد Batch (column-wise for the whole page)
+            page_df = sitewide_page_frame(rows, stype)
+            page_df["unique_key"] = generate_expanded_unique_keys(page_df, dims_for_batch)
+            fetched_dates.update(str(d)[:10] for d in page_df["Date"])
+
+            # ---------- Upsert logic ----------
+            # existing_keys (from main) already holds the window's sitewide keys: no second BigQuery scan
+            in_bq = existing_keys.contains_many(page_df["unique_key"])
+            for day in page_df.loc[in_bq, "Date"]:
+                # در این نسخه فقط لاگ ثبت می‌کنیم؛ در آینده میشه UPDATE کرد
+                print(f"[INFO] Row for {day} already exists → skip (update not implemented)", flush=True)
+            candidates = page_df[~in_bq]
+            batch_new = candidates[existing_keys.add_new(candidates["unique_key"])]
+            new_candidates += len(batch_new)
 
             # ✅ آپلود گروهی رکوردهای جدید
-            if batch_new:
-                df_batch = pd.DataFrame(batch_new)
-                inserted = upload_to_bq(df_batch)
+            if not batch_new.empty:
+                inserted = upload_to_bq(batch_new.copy())
                 total_new_count += inserted
-                all_new_rows.extend(batch_new)
+                new_frames.append(batch_new)
 
             batch_index += 1
-            if len(rows) < ROW_LIMIT:
-                break
-            start_row += len(rows)
-
-    # Step 2: placeholders for missing dates (for each searchType)
-    date_range = pd.date_range(start=start_date, end=end_date)
-    placeholders_only = []
-    for dt in date_range:
-        date_str = dt.strftime("%Y-%m-%d")
-        # check if any row for that date exists in all_new_rows for any stype
-        exists_for_date = any(str(row.get("Date"))[:10] == date_str for row in all_new_rows)
-        if not exists_for_date:
-            for stype in SEARCH_TYPES:
-                placeholder_row = {
-                    "Date": date_str,
-                    "Query": "__SITE_TOTAL__",
-                    "Page": "__SITE_TOTAL__",
-                    "Country": "__NO_COUNTRY__",
-                    "Device": "__NO_DEVICE__",
-                    "SearchAppearance": "__NO_APPEARANCE__",  #Null
-                    "Clicks": 0,
-                    "Impressions": 0,
-                    "CTR": 0,
-                    "Position": 0,
-                    "SearchType": stype,
-                }
-
-                # ✅ کلید یکتا برای placeholder هم با همان ابعاد
-                placeholder_row["unique_key"] = generate_expanded_unique_key(placeholder_row, dims_for_batch)
-
-                if (
-                    placeholder_row["unique_key"] not in existing_bq_keys
-                    and placeholder_row["unique_key"] not in existing_keys
-                ):
-                    existing_keys.add(placeholder_row["unique_key"])
-                    placeholders_only.append(placeholder_row)
-                    print(f"[INFO] Batch 8, Sitewide: adding placeholder for missing date {date_str}", flush=True)
-
-    # ✅ درج یکجای placeholderها
-    placeholders_only = [row for row in all_new_rows if row.get("Clicks") is None]
-    if placeholders_only:
-        df_placeholders = pd.DataFrame(placeholders_only)
-        inserted = upload_to_bq(df_placeholders)
-        total_new_count += inserted
-        all_new_rows.extend(placeholders_only)
+
+    # ---------- Step 2: report dates GSC has no data for yet ----------
+    # no placeholder rows: a placeholder would take the date's sitewide unique_key, and the real
+    # totals GSC publishes for that date later would then be skipped as already existing
+    date_range = pd.date_range(start=start_date, end=end_date).strftime("%Y-%m-%d")
+    missing_dates = [d for d in date_range if d not in fetched_dates]
+    if missing_dates:
+        print(f"[INFO] Batch 8, Sitewide: no GSC data yet for {len(missing_dates)} date(s): {', '.join(missing_dates)}", flush=True)
 
     print(f"[INFO] Batch 8, Sitewide done: fetched_total={fetched_total}, new_candidates={new_candidates}, inserted={total_new_count}", flush=True)
-    return pd.DataFrame(all_new_rows), total_new_count
+    df_site = pd.concat(new_frames, ignore_index=True) if new_frames else pd.DataFrame()
+    return df_site, total_new_count
 
 # ---------- MAIN ----------
 def main():
     ensure_table_and_schema()
+    if SERVER_DEDUP and not DEBUG_MODE:
+        create_staging_table()
     print(f"[INFO] Fetching data from {START_DATE} to {END_DATE}", flush=True)
 
     # ---------- Check existing keys (once, date-limited) ----------
@@ -669,78 +820,35 @@ def main():
     # ----------------------------
     print("[INFO] Fetching Batch 7 (Date + Page, excluding NULL pages)...", flush=True)
     try:
-        service = get_gsc_service()
-        all_rows = []
+        b7_frames = []
         fetched_b7 = 0
         new_b7 = 0
 
         dims_for_batch = ["date", "page"]
 
         for stype in SEARCH_TYPES:
-            start_row = 0
-            while True:
-                print(f"[INFO] Batch 7 fetch for stype={stype}, startRow={start_row}", flush=True)
-                request = {
-                    "startDate": START_DATE,
-                    "endDate": END_DATE,
-                    "dimensions": dims_for_batch,
-                    "rowLimit": ROW_LIMIT,
-                    "startRow": start_row,
-                    "searchType": stype,
-                }
-
-                try:
-                    resp = service.searchanalytics().query(siteUrl=SITE_URL, body=request).execute()
-                except Exception as e:
-                    print(f"[ERROR] Batch 7 fetch error: {e}, retrying in {RETRY_DELAY} sec...", flush=True)
-                    time.sleep(RETRY_DELAY)
-                    continue
-
-                rows = resp.get("rows", [])
-                if not rows:
-                    break
-
+            print(f"[INFO] Batch 7 fetch for stype={stype}", flush=True)
+            request = {
+                "startDate": START_DATE,
+                "endDate": END_DATE,
+                "dimensions": dims_for_batch,
+                "rowLimit": ROW_LIMIT,
+                "searchType": stype,
+            }
+            # PREFETCH_PAGES pages at a time over the shared GSC session; stops after the last (short) page
+            for rows in iter_gsc_pages(request):
                 fetched_b7 += len(rows)
-                for r in rows:
-                    keys = r.get("keys", [])
-                    date = keys[0] if len(keys) > 0 else None
-
-                    # ✅ Normalize date to YYYY-MM-DD (prevent 00:00:00)
-                    if isinstance(date, datetime):
-                        date = date.strftime("%Y-%m-%d")
-                    elif isinstance(date, str):
-                        date = date[:10]
-
-                    if len(keys) == 2 and keys[1]:  # only non-null pages
-                        row = {
-                            "Date": keys[0],
-                            "Query": "__PAGE_TOTAL__",
-                            "Page": keys[1] if len(keys) > 1 else "__NO_PAGE__",
-                            "Country": "__NO_COUNTRY__",
-                            "Device": "__NO_DEVICE__",
-                            "SearchAppearance": "__NO_APPEARANCE__",
-                            "Clicks": r.get("clicks", 0),
-                            "Impressions": r.get("impressions", 0),
-                            "CTR": r.get("ctr", 0.0),
-                            "Position": r.get("position", 0.0),
-                            "SearchType": stype,
-                        }
-
-                        # استفاده از تابع جدید unified
-                        unique_key = generate_expanded_unique_key(row, dims_for_batch)
-                        if unique_key not in existing_keys:
-                            existing_keys.add(unique_key)
-                            row["unique_key"] = unique_key
-                            all_rows.append(row)
-                            new_b7 += 1
-
-                if len(rows) < ROW_LIMIT:
-                    break
-                start_row += len(rows)
+                page_df = page_total_frame(rows, stype)
+                if not page_df.empty:
+                    # استفاده از تابع جدید unified (نسخه‌ی ستونی)
+                    page_df["unique_key"] = generate_expanded_unique_keys(page_df, dims_for_batch)
+                    is_new = existing_keys.add_new(page_df["unique_key"])
+                    b7_frames.append(page_df[is_new])
+                    new_b7 += int(is_new.sum())
 
         inserted_b7 = 0
-        if all_rows:
-            df_batch7 = pd.DataFrame(all_rows)
+        if b7_frames:
+            df_batch7 = pd.concat(b7_frames, ignore_index=True)
             print(f"[INFO] Batch 7 fetched rows: {len(df_batch7)}", flush=True)
             if not df_batch7.empty:
                 inserted_b7 = upload_to_bq(df_batch7)
@@ -760,6 +868,14 @@ def main():
 
     total_all_inserted = inserted_main + inserted_noindex + inserted_b7 + inserted_site
 
+    # rows queued by the load-job fallback (no Write API, or failed appends) go to BigQuery in one job
+    queued_rows = _spool_rows
+    inserted_spool = flush_upload_spool()
+    total_all_inserted += inserted_spool
+    if SERVER_DEDUP and not DEBUG_MODE:
+        # rows above were staged; what is new to the table is only known after the MERGE
+        total_all_inserted = merge_staging_table()
+
     # Compose CSV output if requested
     if CSV_TEST_FILE:
         try:
@@ -794,7 +910,11 @@ def main():
     print(f"  - noindex inserted:       {inserted_noindex}", flush=True)
     print(f"  - batch7 inserted:        {inserted_b7}", flush=True)
     print(f"  - sitewide inserted:      {inserted_site}", flush=True)
+    print(f"  - load job inserted:      {inserted_spool}", flush=True)
     print(f"[INFO] Total new rows fetched/inserted: {total_all_inserted}", flush=True)
+    if inserted_spool < queued_rows:
+        print(f"[ERROR] {queued_rows - inserted_spool} queued rows never reached BigQuery.", flush=True)
+        sys.exit(1)
     print("[INFO] Finished.", flush=True)
 
 
@@ -127,6 +127,14 @@ def _normalize_columns(cols):
         normalized.append(s)
     return normalized
 
+def join_key_columns(df, cols, sep='|'):
+    """
+    Per-row f"{a}|{b}|..." over the given columns (missing column -> ""), zipped column-wise
+    instead of df.apply(axis=1), which builds a whole Series object for every row.
+    """
+    parts = [df[c] if c in df.columns else [''] * len(df) for c in cols]
+    return [sep.join(map(str, vals)) for vals in zip(*parts)]
+
 def detect_url_column(df):
     for col in df.columns:
         cname = col.strip().lower()
@@ -195,8 +203,8 @@ def parse_excel_file(file_path):
 
     # Merge safely on url + item_name (only for non-Valid files)
     if not details_df.empty and not metrics_df.empty and not is_valid_file:
-        details_df['merge_key'] = details_df.apply(lambda r: f"{r.get('url','')}|{r.get('item_name','')}", axis=1)
-        metrics_df['merge_key'] = metrics_df.apply(lambda r: f"{r.get('page','')}|{r.get('item_name','')}", axis=1)
+        details_df['merge_key'] = join_key_columns(details_df, ['url', 'item_name'])
+        metrics_df['merge_key'] = join_key_columns(metrics_df, ['page', 'item_name'])
         merged_df = details_df.merge(metrics_df.drop(columns=['page']), on='merge_key', how='left', suffixes=('','_metric'))
         metrics_fallback = metrics_df.drop(columns=['page','item_name'], errors='ignore')
         if 'url' in metrics_fallback.columns:
@@ -221,18 +229,29 @@ def parse_excel_file(file_path):
 # BLOCK 6: Unique key
 # =================================================
 def build_unique_key_series(df, site, enhancement_name, date_val, status_col='status'):
-    def row_key(r):
-        page = r.get('url') or ""
-        item_name = r.get('item_name') or ""
-        status = r.get(status_col) or ""
-        lastc = r.get('last_crawled')
-        if isinstance(lastc, datetime):
-            lastc = lastc.date()
-        lastc_str = str(lastc) if lastc else ""
-        date_str = str(date_val) if date_val else ""
-        raw = f"{site}|{enhancement_name}|{page}|{item_name}|{status}|{lastc_str}|{date_str}"
-        return hashlib.sha256(raw.encode('utf-8')).hexdigest()
-    return df.apply(row_key, axis=1)
+    """
+    sha256 of site|enhancement|url|item_name|status|last_crawled|date per row, built column-wise
+    (one list per column, constant parts formatted once) instead of df.apply(axis=1).
+    Same per-value rules as the old row function: falsy -> "", datetimes -> their date.
+    """
+    def column(name):
+        return df[name].tolist() if name in df.columns else [None] * len(df)
+
+    def as_date(v):
+        return v.date() if isinstance(v, datetime) else v
+
+    pages = [str(v) if v else "" for v in column('url')]
+    item_names = [str(v) if v else "" for v in column('item_name')]
+    statuses = [str(v) if v else "" for v in column(status_col)]
+    lastcs = [str(v) if v else "" for v in map(as_date, column('last_crawled'))]
+    prefix = f"{site}|{enhancement_name}|"
+    suffix = f"|{date_val if date_val else ''}"
+    sha256 = hashlib.sha256
+    keys = [
+        sha256(f"{prefix}{page}|{item_name}|{status}|{lastc}{suffix}".encode('utf-8')).hexdigest()
+        for page, item_name, status, lastc in zip(pages, item_names, statuses, lastcs)
+    ]
+    return pd.Series(keys, index=df.index, dtype=object)
 
 # =================================================
 # BLOCK 7: BQ helpers
@@ -256,8 +275,8 @@ def ensure_table_exists():
 def get_existing_unique_keys():
     table_ref = f"{PROJECT_ID}.{DATASET_ID}.{TABLE_ID}"
     try:
-        df = bq_client.query(f"SELECT unique_key FROM `{table_ref}`").to_dataframe()
-        return set(df['unique_key'].astype(str).tolist())
+        arrow_tbl = bq_client.query(f"SELECT CAST(unique_key AS STRING) AS unique_key FROM `{table_ref}` WHERE unique_key IS NOT NULL").result().to_arrow()
+        return set(arrow_tbl.column('unique_key').to_pylist())
     except Exception as e:
         print(f"[WARN] Could not fetch existing keys: {e}")
         return set()
@@ -0,0 +1,83 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+# ============================================================
+# File: check_unique_keys.py
+# Revision: Rev.1.0
+# Purpose: Regression check: the vectorized unique_key builders must stay
+#          byte-identical to the per-row reference functions, otherwise
+#          every stored row would be re-inserted under a new key.
+# Run:     PYTHONPATH=src python src/tests/check_unique_keys.py
+# ============================================================
+
+import sys
+from datetime import datetime
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+from utils.gsc_key_utils import generate_expanded_unique_key, generate_expanded_unique_keys, strip_lower
+from utils.gsc_raw_table import stable_key, stable_key_series
+
+# mixed scripts, Unicode case-mapping edge cases, Python-only whitespace, NULLs, NaN and trailing slashes
+ROWS = [
+    {"Date": "2024-03-01", "Query": "خرید کابل", "Page": "https://bamtabridsazan.com/محصولات/", "Country": "irn", "Device": "MOBILE"},
+    {"Date": "2024-03-01", "Query": "  ΟΔΟΣ  ", "Page": "https://example.com/Greek///", "Country": "GRC", "Device": "DESKTOP"},
+    {"Date": "2024-03-02", "Query": "İstanbul STRASSE ß", "Page": "HTTPS://EXAMPLE.COM/", "Country": "tur", "Device": "TABLET"},
+    {"Date": "2024-03-02T00:00:00", "Query": "\u00a0nbsp\u2003", "Page": "/", "Country": "deu", "Device": "mobile"},
+    {"Date": "2024-03-03", "Query": "\x1ctab\tand sep\x1f", "Page": "https://example.com/a/b", "Country": None, "Device": None},
+    {"Date": "2024-03-03", "Query": None, "Page": None, "Country": "", "Device": ""},
+    {"Date": None, "Query": "emoji 🚀 Mixed کلمه", "Page": "https://example.com/ü/", "Country": "USA", "Device": "DESKTOP"},
+    {"Date": "2024-03-04", "Query": "nan country", "Page": "https://example.com/", "Country": np.nan, "Device": np.nan},
+]
+# dimension sets used by the fullfetch batches
+DIM_SETS = [
+    ["date", "query", "page", "country", "device"],
+    ["date", "query", "page"],
+    ["date", "page", "country"],
+    ["date", "query"],
+    ["date"],
+]
+
+# rev3/rev4 raw table: Date as ISO string, datetime or NULL
+RAW_ROWS = [dict(r, Date=d) for r, d in zip(ROWS, [
+    "2024-03-01", datetime(2024, 3, 1, 15, 30), "2024-03-02T10:00:00", None,
+    datetime(2024, 3, 3), "2024-03-03", "2024-03-04", "2024-03-05",
+])]
+
+def check_strip_lower():
+    values = [r["Query"] for r in ROWS if r["Query"] is not None] + [r["Page"] for r in ROWS if r["Page"] is not None]
+    got = strip_lower(pa.array(values, type=pa.string())).to_pylist()
+    expected = [v.strip().lower() for v in values]
+    return [(v, g, e) for v, g, e in zip(values, got, expected) if g != e]
+
+def check_expanded_keys():
+    df = pd.DataFrame(ROWS, dtype=object)
+    mismatches = []
+    for dims in DIM_SETS:
+        got = generate_expanded_unique_keys(df, dims)
+        expected = [generate_expanded_unique_key(row, dims) for row in ROWS]
+        mismatches += [(dims, row) for row, g, e in zip(ROWS, got, expected) if g != e]
+    return mismatches
+
+def check_stable_keys():
+    mismatches = []
+    for rows in (ROWS, RAW_ROWS):
+        got = stable_key_series(pd.DataFrame(rows, dtype=object)).tolist()
+        expected = [stable_key(row) for row in rows]
+        mismatches += [row for row, g, e in zip(rows, got, expected) if g != e]
+    return mismatches
+
+if __name__ == "__main__":
+    failures = 0
+    for name, check in [
+        ("strip_lower", check_strip_lower),
+        ("generate_expanded_unique_keys", check_expanded_keys),
+        ("stable_key_series", check_stable_keys),
+    ]:
+        mismatches = check()
+        if mismatches:
+            failures += len(mismatches)
+            for m in mismatches:
+                print(f"[ERROR] {name} differs from the per-row reference: {m}", flush=True)
+        else:
+            print(f"[INFO] {name}: matches the per-row reference.", flush=True)
+    sys.exit(1 if failures else 0)
@@ -1,11 +1,26 @@
 # gsc-to-bq-debug-batches.py
 import sys
 import os
-from gsc_to_bq import fetch_gsc_data  # تابع اصلی از فایل gsc_to_bq.py
+from gsc_to_bq import fetch_gsc_data, categorize, verify_access  # تابع اصلی از فایل gsc_to_bq.py
 import datetime
 import pandas as pd
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.csv as pacsv
 import ast
 
+# polars اختیاری است؛ در صورت نبودن، همان مسیر pandas/pyarrow اجرا می‌شود
+try:
+    import polars as pl
+except ImportError:
+    pl = None
+
+LOG_BUFFER_SIZE = 1 << 20  # 1 MiB write buffer for output_debug.txt
+
+def write_csv(df, path):
+    """Write df with pyarrow's C++ CSV writer instead of pandas' per-cell formatter."""
+    pacsv.write_csv(pa.Table.from_pandas(df, preserve_index=False), path)
+
 def main():
     # ---------- تنظیمات تست ----------
     batch_size = 25000
@@ -14,13 +29,14 @@ def main():
     start_date = "2025-09-01"
     end_date = "2025-09-30"
 
+    verify_access()
     print(f"Running debug with {total_batches} batches of size {batch_size}")
     print(f"Date range: {start_date} to {end_date}")
 
     all_batches = []
 
     debug_file = "output_debug.txt"
-    with open(debug_file, "w", encoding="utf-8") as f:
+    with open(debug_file, "w", encoding="utf-8", buffering=LOG_BUFFER_SIZE) as f:
 
         for i in range(total_batches):
             print(f"Fetching batch {i+1}...")
@@ -37,50 +53,76 @@ def main():
                 continue
 
             # تبدیل به DataFrame و اضافه کردن batch_id
-            df_batch = pd.DataFrame(batch)
+            df_batch = batch if isinstance(batch, pd.DataFrame) else pd.DataFrame(batch)
             df_batch['batch_id'] = i + 1
 
             all_batches.append(df_batch)
 
-            # نوشتن log
-            for row in batch:
-                f.write(str(row) + "\n")
+            # نوشتن log همین batch (به جای اسکن دوباره‌ی کل داده‌ها در انتها)
+            f.writelines(f"{row}\n" for row in df_batch.to_dict("records"))
 
         if not all_batches:
             print("Warning: No data fetched in any batch! Exiting debug script.")
             f.write("Warning: No data fetched in any batch!\n")
             # ایجاد CSVهای خالی برای artifact
-            pd.DataFrame().to_csv("output_debug.csv", index=False)
-            pd.DataFrame().to_csv("duplicates_report.csv", index=False)
+            write_csv(pd.DataFrame(), "output_debug.csv")
+            write_csv(pd.DataFrame(), "duplicates_report.csv")
             return
 
         # جمع کل ردیف‌ها
-        df_all = pd.concat(all_batches, ignore_index=True)
+        # concat of per-batch categories with different dictionaries falls back to object → re-encode once
+        df_all = categorize(pd.concat(all_batches, ignore_index=True))
         print(f"Total rows fetched: {len(df_all)}")
         f.write(f"\nTotal rows fetched: {len(df_all)}\n")
 
     # ---------- بررسی duplicate و ساخت unique_key جدید ----------
-    if not df_all.empty:
+    if not df_all.empty and pl is not None:
+        # مسیر سریع با polars (اختیاری): همه مراحل ستونی در Rust
+        df_pl = pl.from_pandas(df_all)
+        duplicates = df_pl.filter(df_pl.select(["Query", "Page", "Date"]).is_duplicated())
+        print(f"Found {duplicates.height} duplicates")
+        duplicates.write_csv("duplicates_report.csv")
+
+        df_pl = df_pl.with_columns(
+            pl.concat_str(
+                [pl.col("Query").cast(pl.Utf8), pl.col("Page").cast(pl.Utf8), pl.col("Date").cast(pl.Utf8), pl.col("batch_id").cast(pl.Utf8)],
+                separator="|",
+            ).alias("unique_key_new")
+        )
+        duplicates_after = df_pl.filter(pl.col("unique_key_new").is_duplicated())
+        print(f"Duplicates after unique_key fix: {duplicates_after.height}")
+
+        df_pl.write_csv("output_debug.csv")
+        print("Debug CSV with unique_key_new saved as output_debug.csv")
+
+    elif not df_all.empty:
         # بررسی duplicateهای فعلی بر اساس Query, Page, Date
-        duplicates = df_all[df_all.duplicated(subset=["Query", "Page", "Date"], keep=False)]
+        # یک hash واحد (uint64) برای هر ردیف به جای MultiIndex سه‌ستونی
+        key_hash = pd.util.hash_pandas_object(df_all[["Query", "Page", "Date"]], index=False)
+        duplicates = df_all[key_hash.duplicated(keep=False)]
         print(f"Found {len(duplicates)} duplicates")
-        duplicates.to_csv("duplicates_report.csv", index=False)
+        write_csv(duplicates, "duplicates_report.csv")
 
         # ساخت unique_key جدید با اضافه کردن batch_id
-        df_all["unique_key_new"] = df_all["Query"] + "|" + df_all["Page"] + "|" + df_all["Date"].astype(str) + "|" + df_all["batch_id"].astype(str)
+        # یک kernel در Arrow به جای چهار آرایه‌ی میانی object با '+'
+        key_parts = [
+            pc.cast(pa.array(df_all[col]), pa.string())
+            for col in ["Query", "Page", "Date", "batch_id"]
+        ]
+        df_all["unique_key_new"] = pc.binary_join_element_wise(*key_parts, "|").to_pandas()
 
         # بررسی duplicate بعد از اصلاح
         duplicates_after = df_all[df_all.duplicated(subset=["unique_key_new"], keep=False)]
         print(f"Duplicates after unique_key fix: {len(duplicates_after)}")
 
         # ذخیره CSV نهایی
-        df_all.to_csv("output_debug.csv", index=False)
+        write_csv(df_all, "output_debug.csv")
         print("Debug CSV with unique_key_new saved as output_debug.csv")
 
     else:
         # اگر DataFrame خالی بود، CSV خالی ایجاد می‌کنیم
-        pd.DataFrame().to_csv("output_debug.csv", index=False)
-        pd.DataFrame().to_csv("duplicates_report.csv", index=False)
+        write_csv(pd.DataFrame(), "output_debug.csv")
+        write_csv(pd.DataFrame(), "duplicates_report.csv")
         print("No data available. Empty CSVs created.")
 
     print(f"Debug output saved to {debug_file}")
@@ -5,18 +5,30 @@
 # =================================================
 
 from google.oauth2 import service_account
-from googleapiclient.discovery import build
 from google.cloud import bigquery
 from google.cloud import bigquery
 import pandas as pd
 from datetime import datetime, timedelta
-import hashlib
-import time
+from utils.gsc_raw_table import ensure_table, stable_key_series, RAW_SCHEMA
+from utils.gsc_key_utils import ExistingKeySet
+from utils.gsc_api_utils import build_searchconsole, load_service_account_info
+from utils.gsc_storage_write import append_dataframe
 import os
-import json
 import sys
 import argparse
 import warnings
+import functools
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import quote
+from google.auth.transport.requests import AuthorizedSession
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+# orjson is optional: parses the ~5-10 MB page responses several times faster than stdlib json
+try:
+    import orjson
+except ImportError:
+    orjson = None
 
 # ---------- CONFIG ----------
 SITE_URL = 'https://bamtabridsazan.com/'
@@ -24,7 +36,10 @@ BQ_PROJECT = 'bamtabridsazan'
 BQ_DATASET = 'seo_reports'
 BQ_TABLE = 'bamtabridsazan__gsc__raw_data'
 ROW_LIMIT = 25000
-RETRY_DELAY = 60  # seconds in case of timeout
+GSC_FIELDS = "rows(keys,clicks,impressions,ctr,position)"  # response field mask: only what the loaders read
+GSC_NUM_RETRIES = 5  # retries with exponential backoff on 429/5xx (honours Retry-After) instead of a flat 60 s sleep
+HTTP_TIMEOUT = 300  # seconds per GSC page request
+PREFETCH_PAGES = 4  # GSC pages requested concurrently per round
 
 # ---------- ARGUMENT PARSER ----------
 parser = argparse.ArgumentParser(description="GSC to BigQuery Incremental Loader")
@@ -39,172 +54,186 @@ DEBUG_MODE = args.debug
 
 # ---------- CREDENTIALS ----------
 service_account_file = os.environ.get("SERVICE_ACCOUNT_FILE", "gcp-key.json")
-with open(service_account_file, "r") as f:
-    sa_info = json.load(f)
+sa_info = load_service_account_info(service_account_file)
 
 credentials = service_account.Credentials.from_service_account_info(sa_info)
+gsc_credentials = credentials.with_scopes(["https://www.googleapis.com/auth/webmasters.readonly"])
 
-# Build Search Console service
-service = build('searchconsole', 'v1', credentials=credentials)
+# Build Search Console service (once per process; discovery doc is the copy bundled with
+# google-api-python-client, so no HTTP fetch from the discovery endpoint)
+@functools.lru_cache(maxsize=1)
+def get_service():
+    return build_searchconsole(credentials, static_discovery=True, cache_discovery=False)
 
-# --- Check access ---
-try:
-    response = service.sites().get(siteUrl=SITE_URL).execute()
-    print(f"✅ Service Account has access to {SITE_URL}", flush=True)
-except Exception as e:
-    print(f"❌ Service Account does NOT have access to {SITE_URL}", flush=True)
-    print("Error details:", e)
-    sys.exit(1)
+# --- Check access (run from main, not on import) ---
+def verify_access():
+    try:
+        get_service().sites().get(siteUrl=SITE_URL).execute()
+        print(f"✅ Service Account has access to {SITE_URL}", flush=True)
+    except Exception as e:
+        print(f"❌ Service Account does NOT have access to {SITE_URL}", flush=True)
+        print("Error details:", e)
+        sys.exit(1)
 
 # ---------- BIGQUERY CLIENT ----------
 bq_client = bigquery.Client(credentials=credentials, project=credentials.project_id)
 table_ref = bq_client.dataset(BQ_DATASET).table(BQ_TABLE)
 
-# ---------- ENSURE TABLE EXISTS ----------
-def ensure_table():
-    try:
-        bq_client.get_table(table_ref)
-        print(f"[INFO] Table {BQ_TABLE} exists.", flush=True)
-    except:
-        print(f"[INFO] Table {BQ_TABLE} not found. Creating...", flush=True)
-        schema = [
-            bigquery.SchemaField("Date", "DATE"),
-            bigquery.SchemaField("Query", "STRING"),
-            bigquery.SchemaField("Page", "STRING"),
-            bigquery.SchemaField("Clicks", "INTEGER"),
-            bigquery.SchemaField("Impressions", "INTEGER"),
-            bigquery.SchemaField("CTR", "FLOAT"),
-            bigquery.SchemaField("Position", "FLOAT"),
-            bigquery.SchemaField("unique_key", "STRING"),
-        ]
-        table = bigquery.Table(table_ref, schema=schema)
-        table.clustering_fields = ["Date", "Query"]
-        bq_client.create_table(table)
-        print(f"[INFO] Table {BQ_TABLE} created.", flush=True)
-
-# ---------- HELPER: create unique key ----------
-def stable_key(row):
-    query = (row.get('Query') or '').strip().lower()
-    page = (row.get('Page') or '').strip().lower().rstrip('/')
-    date_raw = row.get('Date')
-    if isinstance(date_raw, str):
-        date = date_raw[:10]
-    elif isinstance(date_raw, datetime):
-        date = date_raw.strftime("%Y-%m-%d")
-    else:
-        date = str(date_raw)[:10]
-    det_tuple = (query, page, date)
-    s = "|".join(det_tuple)
-    return hashlib.sha256(s.encode('utf-8')).hexdigest()
+# ---------- HELPER: GSC rows -> DataFrame ----------
+def rows_to_frame(rows):
+    """Build the page DataFrame column-wise (one list per column) instead of transposing a list of row lists."""
+    dates, queries, pages = (list(col) for col in zip(*(r['keys'] for r in rows)))
+    return pd.DataFrame({
+        'Date': dates,
+        'Query': queries,
+        'Page': pages,
+        'Clicks': [r.get('clicks',0) for r in rows],
+        'Impressions': [r.get('impressions',0) for r in rows],
+        'CTR': [r.get('ctr',0) for r in rows],
+        'Position': [r.get('position',0) for r in rows],
+    })
 
 # ---------- FETCH EXISTING KEYS FROM BIGQUERY ----------
-def get_existing_keys():
+# cache the BigQuery snapshot per (start_date, end_date): the debug harness calls fetch_gsc_data repeatedly
+# for the same window. Each call gets its own copy, since fetch_gsc_data adds the run's keys to it.
+_EXISTING_KEYS_CACHE = {}
+
+def get_existing_keys(start_date, end_date):
+    cache_key = (start_date, end_date)
+    if cache_key in _EXISTING_KEYS_CACHE:
+        keys = _EXISTING_KEYS_CACHE[cache_key].copy()
+        print(f"[INFO] Reusing {len(keys)} cached existing keys for {start_date} to {end_date}.", flush=True)
+        return keys
     try:
-        query = f"SELECT unique_key FROM `{BQ_PROJECT}.{BQ_DATASET}.{BQ_TABLE}`"
+        # unique_key is derived from Date, so only rows inside the fetch window can collide
+        query = f"SELECT unique_key FROM `{BQ_PROJECT}.{BQ_DATASET}.{BQ_TABLE}` WHERE Date BETWEEN @start_date AND @end_date"
+        job_config = bigquery.QueryJobConfig(query_parameters=[
+            bigquery.ScalarQueryParameter("start_date", "DATE", start_date),
+            bigquery.ScalarQueryParameter("end_date", "DATE", end_date),
+        ])
 
         # ایجاد کلاینت BigQuery Storage
         try:
             from google.cloud import bigquery_storage
             bqstorage_client = bigquery_storage.BigQueryReadClient()
-            use_bqstorage = True
         except Exception:
             bqstorage_client = None
-            use_bqstorage = False
 
-        # فراخوانی Query و تبدیل به DataFrame با چک Storage
-        if use_bqstorage:
-            df = bq_client.query(query).to_dataframe(bqstorage_client=bqstorage_client)
-        else:
-            with warnings.catch_warnings():
-                warnings.simplefilter("ignore")
-                df = bq_client.query(query).to_dataframe()
+        # دریافت مستقیم به صورت Arrow (بدون ساخت DataFrame)
+        with warnings.catch_warnings():
+            warnings.simplefilter("ignore")
+            arrow_table = bq_client.query(query, job_config=job_config).result().to_arrow(bqstorage_client=bqstorage_client)
 
-        print(f"[INFO] Retrieved {len(df)} existing keys from BigQuery.", flush=True)
-        return set(df['unique_key'].astype(str).tolist())
+        # sorted uint64 prefixes (8 bytes/key, exact) instead of a set of Python ints (~70 bytes/key);
+        # keys inserted by this run go to the set's own small mutable part
+        keys = ExistingKeySet(arrow_table.column('unique_key').to_pylist())
+        print(f"[INFO] Retrieved {len(keys)} existing keys from BigQuery.", flush=True)
+        _EXISTING_KEYS_CACHE[cache_key] = keys
+        return keys.copy()
 
     except Exception as e:
         print(f"[WARN] Failed to fetch existing keys: {e}", flush=True)
-        return set()
+        return ExistingKeySet()
 
 # ---------- UPLOAD TO BIGQUERY ----------
 def upload_to_bq(df):
     if df.empty:
         print("[INFO] No new rows to insert.", flush=True)
         return
-    df['Date'] = pd.to_datetime(df['Date'])
     if DEBUG_MODE:
         print(f"[DEBUG] Debug mode ON: skipping insert of {len(df)} rows to BigQuery")
         return
+    # Storage Write API (_default stream): ~5 MB gRPC appends per page instead of legacy streaming inserts
     try:
-        job = bq_client.load_table_from_dataframe(df, table_ref)
-        job.result()
-        print(f"[INFO] Inserted {len(df)} rows to BigQuery.", flush=True)
+        inserted = append_dataframe(table_ref, RAW_SCHEMA, df, credentials=credentials)
+        print(f"[INFO] Inserted {inserted} rows to BigQuery.", flush=True)
     except Exception as e:
-        print(f"[ERROR] Failed to insert rows: {e}", flush=True)
+        print(f"[ERROR] Failed to insert {len(df)} rows: {e}", flush=True)
+
+# ---------- FETCH ONE GSC PAGE (thread-safe) ----------
+# one pooled keep-alive HTTPS session shared by all worker threads: the TLS handshake and the
+# OAuth token are paid once per connection instead of per page (urllib3's pool is thread-safe)
+GSC_QUERY_URL = f"https://searchconsole.googleapis.com/webmasters/v3/sites/{quote(SITE_URL, safe='')}/searchAnalytics/query"
+gsc_session = AuthorizedSession(gsc_credentials)
+# transient failures (429/5xx, dropped connections, timeouts) are retried by urllib3 with exponential
+# backoff and Retry-After; anything else, or still failing after GSC_NUM_RETRIES, raises to the caller
+GSC_RETRY = Retry(
+    total=GSC_NUM_RETRIES,
+    backoff_factor=2,
+    status_forcelist=(429, 500, 502, 503, 504),
+    allowed_methods=None,  # searchAnalytics.query is a read-only POST
+    respect_retry_after_header=True,
+    raise_on_status=False,
+)
+gsc_session.mount("https://", HTTPAdapter(pool_connections=1, pool_maxsize=PREFETCH_PAGES, max_retries=GSC_RETRY))
+
+def fetch_gsc_page(start_date, end_date, start_row):
+    request = {
+        'startDate': start_date,
+        'endDate': end_date,
+        'dimensions': ['date','query','page'],
+        'rowLimit': ROW_LIMIT,
+        'startRow': start_row
+    }
+    resp = gsc_session.post(GSC_QUERY_URL, params={"fields": GSC_FIELDS}, json=request, timeout=HTTP_TIMEOUT)
+    resp.raise_for_status()
+    payload = orjson.loads(resp.content) if orjson is not None else resp.json()
+    return payload.get('rows', [])
+
+# ---------- HELPER: compact repeated strings ----------
+REPEATED_STR_COLS = ['Query', 'Page']  # same Page on every query/day, same Query on many days
+
+def categorize(df):
+    """Store Query/Page as category (int codes + one dictionary) instead of one Python str per row."""
+    for col in REPEATED_STR_COLS:
+        df[col] = df[col].astype('category')
+    return df
 
 # ---------- FETCH GSC DATA ----------
 def fetch_gsc_data(start_date, end_date):
-    all_rows = []
+    all_frames = []
     start_row = 0
-    existing_keys = get_existing_keys()
+    existing_keys = get_existing_keys(start_date, end_date)
     batch_index = 1
+    done = False
 
-    while True:
-        request = {
-            'startDate': start_date,
-            'endDate': end_date,
-            'dimensions': ['date','query','page'],
-            'rowLimit': ROW_LIMIT,
-            'startRow': start_row
-        }
+    with ThreadPoolExecutor(max_workers=PREFETCH_PAGES) as pool:
+        while not done:
+            # speculatively request the next PREFETCH_PAGES pages at once; results come back in startRow order
+            offsets = [start_row + k * ROW_LIMIT for k in range(PREFETCH_PAGES)]
+            pages = pool.map(lambda offset: fetch_gsc_page(start_date, end_date, offset), offsets)
 
-        try:
-            resp = service.searchanalytics().query(siteUrl=SITE_URL, body=request).execute()
-        except Exception as e:
-            print(f"[ERROR] Timeout or error: {e}, retrying in {RETRY_DELAY} sec...", flush=True)
-            time.sleep(RETRY_DELAY)
-            continue
-
-        rows = resp.get('rows', [])
-        if not rows:
-            print("[INFO] No more rows returned from GSC.", flush=True)
-            break
-
-        batch_count = 0
-        batch_new_rows = []
-        for r in rows:
-            date = r['keys'][0]
-            query_text = r['keys'][1]
-            page = r['keys'][2]
-            clicks = r.get('clicks',0)
-            impressions = r.get('impressions',0)
-            ctr = r.get('ctr',0)
-            position = r.get('position',0)
-            key = stable_key({
-                'Query': query_text,
-                'Page': page,
-                'Date': date
-            })
-            if key not in existing_keys:
-                existing_keys.add(key)
-                batch_new_rows.append([date, query_text, page, clicks, impressions, ctr, position, key])
-                batch_count += 1
-
-        print(f"[INFO] Batch {batch_index}: Fetched {len(rows)} rows, {batch_count} new rows.", flush=True)
-        if batch_new_rows:
-            df_batch = pd.DataFrame(batch_new_rows, columns=['Date','Query','Page','Clicks','Impressions','CTR','Position','unique_key'])
-            upload_to_bq(df_batch)
-
-        batch_index += 1
-        if len(rows) < ROW_LIMIT:
-            break
-        start_row += len(rows)
-
-    return pd.DataFrame(all_rows, columns=['Date','Query','Page','Clicks','Impressions','CTR','Position','unique_key'])
+            for rows in pages:
+                if not rows:
+                    print("[INFO] No more rows returned from GSC.", flush=True)
+                    done = True
+                    break
+
+                df_page = rows_to_frame(rows)
+                df_page['unique_key'] = stable_key_series(df_page)
+
+                # bulk membership: one vectorized lookup per page instead of a Python branch per row
+                df_batch = df_page[existing_keys.add_new(df_page['unique_key'])]
+
+                print(f"[INFO] Batch {batch_index}: Fetched {len(rows)} rows, {len(df_batch)} new rows.", flush=True)
+                if not df_batch.empty:
+                    upload_to_bq(df_batch.copy())
+                    all_frames.append(df_batch)
+
+                batch_index += 1
+                if len(rows) < ROW_LIMIT:
+                    done = True
+                    break
+                start_row += len(rows)
+
+    if not all_frames:
+        return pd.DataFrame(columns=['Date','Query','Page','Clicks','Impressions','CTR','Position','unique_key'])
+    return categorize(pd.concat(all_frames, ignore_index=True))
 
 # ---------- MAIN ----------
 if __name__ == "__main__":
-    ensure_table()
+    ensure_table(bq_client, table_ref)
+    verify_access()
     df = fetch_gsc_data(START_DATE, END_DATE)
 
     # اگر insert_rows_to_bigquery در جای دیگری اجرا می‌شود، همان‌جا این را اضافه کنید
@@ -1,9 +1,8 @@
 import pandas as pd
+import csv
 from googleapiclient.discovery import build
 from google.oauth2 import service_account
 from datetime import datetime, timedelta, date
-import hashlib
-import time
 import os
 import json
 import sys
@@ -12,7 +11,8 @@ import warnings
 # ---------- CONFIG ----------
 SITE_URL = 'https://bamtabridsazan.com/'
 ROW_LIMIT = 25000
-RETRY_DELAY = 60  # seconds
+GSC_FIELDS = "rows(keys,clicks,impressions,ctr,position)"  # response field mask: only what the loaders read
+GSC_NUM_RETRIES = 5  # retries with exponential backoff on 429/5xx (honours Retry-After) instead of a flat 60 s sleep
 CSV_OUTPUT = f'gsc_fullfetch_test_{date.today()}.csv'
 
 # ---------- CREDENTIALS ----------
@@ -28,17 +28,25 @@ END_DATE = datetime.utcnow().strftime('%Y-%m-%d')
 
 # ---------- DIMENSIONS ----------
 DIMENSIONS = ["query", "page", "country", "device", "searchAppearance", "date"]
+CSV_COLUMNS = ["date", "dimension_type", "dimension_value", "clicks", "impressions", "ctr", "position", "unique_key"]
 
 # ---------- HELPER ----------
-def stable_key(record, dimension):
-    value = record.get('value','').strip().lower()
-    date_val = record.get('date', START_DATE)
-    s = f"{dimension}|{value}|{date_val}"
-    return hashlib.sha256(s.encode('utf-8')).hexdigest()
+def stable_key_column(df):
+    """
+    unique_key for the whole frame in one vectorized call (64-bit SipHash via pandas).
+    This test only writes a CSV, so the key does not need to match the SHA256 keys stored in BigQuery.
+    """
+    normalized = pd.DataFrame({
+        "dimension_type": df["dimension_type"],
+        "dimension_value": df["dimension_value"].astype(str).str.strip().str.lower(),
+        "date": df["date"].astype(str),
+    })
+    return pd.util.hash_pandas_object(normalized, index=False).astype(str)
 
 # ---------- FETCH GSC DATA ----------
-def fetch_gsc_data(start_date, end_date, dimension):
-    all_rows = []
+def fetch_gsc_data(start_date, end_date, dimension, csv_writer):
+    """Fetch one dimension and write each batch straight to csv_writer; returns the number of rows written."""
+    total_rows = 0
     start_row = 0
     batch_index = 1
 
@@ -50,49 +58,41 @@ def fetch_gsc_data(start_date, end_date, dimension):
             'rowLimit': ROW_LIMIT,
             'startRow': start_row
         }
-        try:
-            resp = service.searchanalytics().query(siteUrl=SITE_URL, body=request).execute()
-        except Exception as e:
-            print(f"[ERROR] Timeout or error: {e}, retrying in {RETRY_DELAY} sec...")
-            time.sleep(RETRY_DELAY)
-            continue
+        # 429/5xx/connection errors: exponential backoff inside googleapiclient, then raise
+        resp = service.searchanalytics().query(siteUrl=SITE_URL, body=request, fields=GSC_FIELDS).execute(num_retries=GSC_NUM_RETRIES)
 
         rows = resp.get('rows', [])
         if not rows:
             break
 
-        batch_new_rows = []
-        for r in rows:
-            value = r['keys'][0] if r.get('keys') else ""
-            record_date = r['keys'][0] if dimension=="date" else start_date
-            batch_new_rows.append({
-                "date": record_date,
-                "dimension_type": dimension,
-                "dimension_value": value,
-                "clicks": r.get('clicks',0),
-                "impressions": r.get('impressions',0),
-                "ctr": r.get('ctr',0),
-                "position": r.get('position',0),
-                "unique_key": stable_key({'value': value,'date':record_date}, dimension)
-            })
-
         print(f"[INFO] Dimension '{dimension}', Batch {batch_index}: Fetched {len(rows)} rows", flush=True)
-        all_rows.extend(batch_new_rows)
+        # one list per column instead of a dict per row; the batch is streamed to the CSV right away
+        df_batch = pd.DataFrame({
+            "date": [r['keys'][0] for r in rows] if dimension=="date" else start_date,
+            "dimension_type": dimension,
+            "dimension_value": [r['keys'][0] if r.get('keys') else "" for r in rows],
+            "clicks": [r.get('clicks',0) for r in rows],
+            "impressions": [r.get('impressions',0) for r in rows],
+            "ctr": [r.get('ctr',0) for r in rows],
+            "position": [r.get('position',0) for r in rows],
+        }, index=pd.RangeIndex(len(rows)))
+        df_batch["unique_key"] = stable_key_column(df_batch)
+        csv_writer.writerows(df_batch[CSV_COLUMNS].itertuples(index=False, name=None))
+        total_rows += len(df_batch)
         batch_index += 1
         if len(rows) < ROW_LIMIT:
             break
         start_row += len(rows)
 
-    return all_rows
+    return total_rows
 
 # ---------- MAIN ----------
 if __name__ == "__main__":
-    all_data = []
-    for dim in DIMENSIONS:
-        print(f"[INFO] Fetching data for dimension: {dim}", flush=True)
-        dim_rows = fetch_gsc_data(START_DATE, END_DATE, dim)
-        all_data.extend(dim_rows)
-
-    df = pd.DataFrame(all_data)
-    df.to_csv(CSV_OUTPUT, index=False)
-    print(f"[INFO] Exported {len(df)} rows to {CSV_OUTPUT}", flush=True)
+    total_rows = 0
+    with open(CSV_OUTPUT, "w", newline="", encoding="utf-8") as f:
+        csv_writer = csv.writer(f, lineterminator="\n")
+        csv_writer.writerow(CSV_COLUMNS)
+        for dim in DIMENSIONS:
+            print(f"[INFO] Fetching data for dimension: {dim}", flush=True)
+            total_rows += fetch_gsc_data(START_DATE, END_DATE, dim, csv_writer)
+    print(f"[INFO] Exported {total_rows} rows to {CSV_OUTPUT}", flush=True)
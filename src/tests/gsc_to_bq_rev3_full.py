@@ -5,15 +5,19 @@
 # =================================================
 
 from google.oauth2 import service_account
-from googleapiclient.discovery import build
 from google.cloud import bigquery
 import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
 from datetime import datetime, timedelta
 import hashlib
-import time
+from utils.gsc_raw_table import ensure_table, stable_key_series
+from utils.gsc_key_utils import ExistingKeySet
+from utils.gsc_api_utils import build_searchconsole, load_service_account_info
 import os
-import json
 import sys
+import tempfile
+import uuid
 
 # ---------- CONFIG ----------
 SITE_URL = 'https://bamtabridsazan.com/'
@@ -21,160 +25,223 @@ BQ_PROJECT = 'bamtabridsazan'
 BQ_DATASET = 'seo_reports'
 BQ_TABLE = 'bamtabridsazan__gsc__raw_data'
 ROW_LIMIT = 25000
+GSC_FIELDS = "rows(keys,clicks,impressions,ctr,position)"  # response field mask: only what the loaders read
 START_DATE = (datetime.utcnow() - timedelta(days=480)).strftime('%Y-%m-%d')  # 16 months ago
 END_DATE = (datetime.utcnow() - timedelta(days=1)).strftime('%Y-%m-%d')        # yesterday
-RETRY_DELAY = 60  # seconds in case of timeout
+GSC_NUM_RETRIES = 5  # retries with exponential backoff on 429/5xx (honours Retry-After) instead of a flat 60 s sleep
+CACHE_DIR = os.environ.get("GSC_CACHE_DIR", ".gsc_cache")  # parquet cache of settled GSC pages
+SITE_CACHE_DIR = os.path.join(CACHE_DIR, hashlib.sha256(SITE_URL.encode('utf-8')).hexdigest()[:16])
+SETTLE_DAYS = 3  # GSC keeps revising the most recent days; never cache windows that reach into them
 
 # ---------- CREDENTIALS ----------
 service_account_file = os.environ.get("SERVICE_ACCOUNT_FILE", "gcp-key.json")
-with open(service_account_file, "r") as f:
-    sa_info = json.load(f)
+sa_info = load_service_account_info(service_account_file)
 
 credentials = service_account.Credentials.from_service_account_info(sa_info)
 
 # Build Search Console service
-service = build('searchconsole', 'v1', credentials=credentials)
+service = build_searchconsole(credentials)
 
-# --- Check access ---
-try:
-    response = service.sites().get(siteUrl=SITE_URL).execute()
-    print(f"✅ Service Account has access to {SITE_URL}", flush=True)
-except Exception as e:
-    print(f"❌ Service Account does NOT have access to {SITE_URL}", flush=True)
-    print("Error details:", e)
-    sys.exit(1)
+# --- Check access (run from main, not on import) ---
+def verify_access():
+    try:
+        service.sites().get(siteUrl=SITE_URL).execute()
+        print(f"✅ Service Account has access to {SITE_URL}", flush=True)
+    except Exception as e:
+        print(f"❌ Service Account does NOT have access to {SITE_URL}", flush=True)
+        print("Error details:", e)
+        sys.exit(1)
 
 # ---------- BIGQUERY CLIENT ----------
 bq_client = bigquery.Client(credentials=credentials, project=credentials.project_id)
 table_ref = bq_client.dataset(BQ_DATASET).table(BQ_TABLE)
 
-# ---------- ENSURE TABLE EXISTS ----------
-def ensure_table():
-    try:
-        bq_client.get_table(table_ref)
-        print(f"[INFO] Table {BQ_TABLE} exists.", flush=True)
-    except:
-        print(f"[INFO] Table {BQ_TABLE} not found. Creating...", flush=True)
-        schema = [
-            bigquery.SchemaField("Date", "DATE"),
-            bigquery.SchemaField("Query", "STRING"),
-            bigquery.SchemaField("Page", "STRING"),
-            bigquery.SchemaField("Clicks", "INTEGER"),
-            bigquery.SchemaField("Impressions", "INTEGER"),
-            bigquery.SchemaField("CTR", "FLOAT"),
-            bigquery.SchemaField("Position", "FLOAT"),
-            bigquery.SchemaField("unique_key", "STRING"),
-        ]
-        table = bigquery.Table(table_ref, schema=schema)
-        table.clustering_fields = ["Date", "Query"]
-        bq_client.create_table(table)
-        print(f"[INFO] Table {BQ_TABLE} created.", flush=True)
-
-# ---------- HELPER: create unique key ----------
-def stable_key(row):
-    query = (row.get('Query') or '').strip().lower()
-    page = (row.get('Page') or '').strip().lower().rstrip('/')
-    date_raw = row.get('Date')
-    if isinstance(date_raw, str):
-        date = date_raw[:10]
-    elif isinstance(date_raw, datetime):
-        date = date_raw.strftime("%Y-%m-%d")
-    else:
-        date = str(date_raw)[:10]
-
-    det_tuple = (query, page, date)
-    s = "|".join(det_tuple)
-    return hashlib.sha256(s.encode('utf-8')).hexdigest()
-
-# ---------- FETCH EXISTING KEYS FROM BIGQUERY ----------
-def get_existing_keys():
-    try:
-        query = f"SELECT unique_key FROM `{BQ_PROJECT}.{BQ_DATASET}.{BQ_TABLE}`"
-        df = bq_client.query(query).to_dataframe()
-        print(f"[INFO] Retrieved {len(df)} existing keys from BigQuery.", flush=True)
-        return set(df['unique_key'].astype(str).tolist())
-    except Exception as e:
-        print(f"[WARN] Failed to fetch existing keys: {e}", flush=True)
-        return set()
+# ---------- HELPER: GSC rows -> DataFrame ----------
+def rows_to_frame(rows):
+    """Build the page DataFrame column-wise (one list per column) instead of transposing a list of row lists."""
+    dates, queries, pages = (list(col) for col in zip(*(r['keys'] for r in rows)))
+    return pd.DataFrame({
+        'Date': dates,
+        'Query': queries,
+        'Page': pages,
+        'Clicks': [r.get('clicks',0) for r in rows],
+        'Impressions': [r.get('impressions',0) for r in rows],
+        'CTR': [r.get('ctr',0) for r in rows],
+        'Position': [r.get('position',0) for r in rows],
+    })
 
 # ---------- UPLOAD TO BIGQUERY ----------
-def upload_to_bq(df, debug=False):
-    if df.empty:
+# Arrow layout of the upload file: Date as DATE, Query/Page dictionary-encoded (they repeat on every day/query)
+UPLOAD_SCHEMA = pa.schema([
+    ('Date', pa.date32()),
+    ('Query', pa.dictionary(pa.int32(), pa.string())),
+    ('Page', pa.dictionary(pa.int32(), pa.string())),
+    ('Clicks', pa.int64()),
+    ('Impressions', pa.int64()),
+    ('CTR', pa.float64()),
+    ('Position', pa.float64()),
+    ('unique_key', pa.string()),
+])
+
+def page_to_arrow(df):
+    """Filtered page -> Arrow table in UPLOAD_SCHEMA, ready to append to the run's Parquet spool file."""
+    return pa.Table.from_pandas(df.assign(Date=pd.to_datetime(df['Date'], format='%Y-%m-%d', cache=True).dt.date), schema=UPLOAD_SCHEMA, preserve_index=False)
+
+def upload_to_bq(parquet_path, n_rows, start_date, end_date, debug=False):
+    """
+    Load the spool file into a per-run stage table, then MERGE ... WHEN NOT MATCHED into the raw table.
+    Duplicates against existing rows are dropped server-side; returns the number of rows inserted.
+    The target side is bounded to [start_date, end_date] so the MERGE only reads those Date partitions.
+    """
+    if n_rows == 0:
         print("[INFO] No new rows to insert.", flush=True)
-        return
-    df['Date'] = pd.to_datetime(df['Date'])
+        return 0
     if debug:
-        print(f"[DEBUG] Debug mode ON: skipping insert of {len(df)} rows to BigQuery")
-        return
+        print(f"[DEBUG] Debug mode ON: skipping insert of {n_rows} rows to BigQuery")
+        return 0
+    full_table_id = f"{BQ_PROJECT}.{BQ_DATASET}.{BQ_TABLE}"
+    stage_table_id = f"{full_table_id}__stage_{uuid.uuid4().hex[:8]}"
     try:
-        job = bq_client.load_table_from_dataframe(df, table_ref)
+        job_config = bigquery.LoadJobConfig(
+            source_format=bigquery.SourceFormat.PARQUET,
+            write_disposition="WRITE_TRUNCATE",
+            schema=bq_client.get_table(table_ref).schema,
+        )
+        with open(parquet_path, 'rb') as f:
+            job = bq_client.load_table_from_file(f, stage_table_id, job_config=job_config)
         job.result()
-        print(f"[INFO] Inserted {len(df)} rows to BigQuery.", flush=True)
+        # unique_key includes Date, so a duplicate of a row fetched for this window can only sit in its partitions
+        merge_job = bq_client.query(f"""
+            MERGE `{full_table_id}` T
+            USING `{stage_table_id}` S
+            ON T.unique_key = S.unique_key AND T.Date BETWEEN @start_date AND @end_date
+            WHEN NOT MATCHED THEN INSERT ROW
+        """, job_config=bigquery.QueryJobConfig(query_parameters=[
+            bigquery.ScalarQueryParameter("start_date", "DATE", start_date),
+            bigquery.ScalarQueryParameter("end_date", "DATE", end_date),
+        ]))
+        merge_job.result()
+        inserted = merge_job.num_dml_affected_rows or 0
+        print(f"[INFO] Inserted {inserted} rows to BigQuery, {n_rows - inserted} already present.", flush=True)
+        return inserted
     except Exception as e:
         print(f"[ERROR] Failed to insert rows: {e}", flush=True)
+        return 0
+    finally:
+        bq_client.delete_table(stage_table_id, not_found_ok=True)
+
+# ---------- GSC PAGE CACHE ----------
+def month_windows(start_date, end_date):
+    """Split [start_date, end_date] on calendar-month boundaries so older windows stay identical between runs."""
+    start = datetime.strptime(start_date, '%Y-%m-%d')
+    end = datetime.strptime(end_date, '%Y-%m-%d')
+    while start <= end:
+        next_month = (start.replace(day=1) + timedelta(days=32)).replace(day=1)
+        win_end = min(end, next_month - timedelta(days=1))
+        yield start.strftime('%Y-%m-%d'), win_end.strftime('%Y-%m-%d')
+        start = next_month
+
+def prune_page_cache(start_date, end_date):
+    """
+    Delete cached pages whose window is not one of this run's month_windows: the rolling START_DATE
+    retires a window every day, and the CI cache would otherwise keep every one of them.
+    """
+    if not os.path.isdir(SITE_CACHE_DIR):
+        return
+    live = {f"{win_start}_{win_end}_" for win_start, win_end in month_windows(start_date, end_date)}
+    removed = 0
+    for name in os.listdir(SITE_CACHE_DIR):
+        # file name: <window start>_<window end>_<startRow>.parquet
+        if name[:22] not in live:
+            os.remove(os.path.join(SITE_CACHE_DIR, name))
+            removed += 1
+    if removed:
+        print(f"[INFO] Pruned {removed} cached GSC pages outside {start_date}..{end_date}.", flush=True)
+
+def fetch_gsc_page(start_date, end_date, start_row):
+    """
+    One GSC page as a DataFrame. Pages of windows that end before the last SETTLE_DAYS days are
+    final, so they are read from / written to a zstd parquet file named by (window, startRow)
+    under the site's cache directory.
+    """
+    settled_before = (datetime.utcnow() - timedelta(days=SETTLE_DAYS)).strftime('%Y-%m-%d')
+    cacheable = end_date < settled_before
+    cache_path = os.path.join(SITE_CACHE_DIR, f"{start_date}_{end_date}_{start_row}.parquet")
+    if cacheable and os.path.exists(cache_path):
+        return pd.read_parquet(cache_path)
+
+    request = {
+        'startDate': start_date,
+        'endDate': end_date,
+        'dimensions': ['date','query','page'],
+        'rowLimit': ROW_LIMIT,
+        'startRow': start_row
+    }
+    # 429/5xx/connection errors: exponential backoff inside googleapiclient, then raise
+    resp = service.searchanalytics().query(siteUrl=SITE_URL, body=request, fields=GSC_FIELDS).execute(num_retries=GSC_NUM_RETRIES)
+
+    rows = resp.get('rows', [])
+    df_page = rows_to_frame(rows) if rows else pd.DataFrame(columns=['Date','Query','Page','Clicks','Impressions','CTR','Position'])
+    if cacheable:
+        os.makedirs(SITE_CACHE_DIR, exist_ok=True)
+        df_page.to_parquet(cache_path, compression='zstd', index=False)
+    return df_page
 
 # ---------- FETCH GSC DATA ----------
 def fetch_gsc_data(start_date, end_date, debug=False):
-    all_rows = []
-    start_row = 0
-    existing_keys = get_existing_keys()
+    # new rows are streamed page by page into one zstd Parquet spool file instead of being kept as DataFrames
+    spool_path = os.path.join(tempfile.gettempdir(), f"gsc_rev3_new_rows_{os.getpid()}.parquet")
+    writer = None
+    total_new = 0
+    # duplicates against BigQuery are removed by the MERGE in upload_to_bq; only keys of this run are tracked here
+    # (sorted uint64 prefixes, not a set of Python ints)
+    seen_keys = ExistingKeySet()
     batch_index = 1
+    prune_page_cache(start_date, end_date)
+
+    for win_start, win_end in month_windows(start_date, end_date):
+        start_row = 0
+        while True:
+            df_page = fetch_gsc_page(win_start, win_end, start_row)
+            if df_page.empty:
+                print(f"[INFO] No more rows returned from GSC for {win_start}..{win_end}.", flush=True)
+                break
 
-    while True:
-        request = {
-            'startDate': start_date,
-            'endDate': end_date,
-            'dimensions': ['date','query','page'],
-            'rowLimit': ROW_LIMIT,
-            'startRow': start_row
-        }
-
-        try:
-            resp = service.searchanalytics().query(siteUrl=SITE_URL, body=request).execute()
-        except Exception as e:
-            print(f"[ERROR] Timeout or error: {e}, retrying in {RETRY_DELAY} sec...", flush=True)
-            time.sleep(RETRY_DELAY)
-            continue
-
-        rows = resp.get('rows', [])
-        if not rows:
-            print("[INFO] No more rows returned from GSC.", flush=True)
-            break
-
-        new_rows_in_batch = []
-        for r in rows:
-            date, query_text, page = r['keys']
-            clicks = r.get('clicks',0)
-            impressions = r.get('impressions',0)
-            ctr = r.get('ctr',0)
-            position = r.get('position',0)
-            key = stable_key({'Query': query_text,'Page': page,'Date': date})
-            if key not in existing_keys:
-                existing_keys.add(key)
-                new_rows_in_batch.append([date, query_text, page, clicks, impressions, ctr, position, key])
-
-        print(f"[INFO] Batch {batch_index}: Fetched {len(rows)} rows, {len(new_rows_in_batch)} new rows.", flush=True)
-
-        if new_rows_in_batch:
-            df_batch = pd.DataFrame(
-                new_rows_in_batch,
-                columns=['Date','Query','Page','Clicks','Impressions','CTR','Position','unique_key']
-            )
-            upload_to_bq(df_batch, debug=debug)
-            all_rows.extend(new_rows_in_batch)
-        else:
-            print(f"[INFO] Batch {batch_index} has no new rows.", flush=True)
-
-        if len(rows) < ROW_LIMIT:
-            break
-        start_row += len(rows)
-        batch_index += 1
-
-    return pd.DataFrame(all_rows, columns=['Date','Query','Page','Clicks','Impressions','CTR','Position','unique_key'])
+            df_page['unique_key'] = stable_key_series(df_page)
+
+            # bulk membership: one vectorized lookup per page instead of a Python branch per row
+            df_batch = df_page[seen_keys.add_new(df_page['unique_key'])]
+
+            print(f"[INFO] Batch {batch_index}: Fetched {len(df_page)} rows, {len(df_batch)} candidate rows.", flush=True)
+
+            if not df_batch.empty:
+                if writer is None:
+                    writer = pq.ParquetWriter(spool_path, UPLOAD_SCHEMA, compression='zstd', use_dictionary=True)
+                writer.write_table(page_to_arrow(df_batch))
+                total_new += len(df_batch)
+            else:
+                print(f"[INFO] Batch {batch_index} has no candidate rows.", flush=True)
+
+            batch_index += 1
+            if len(df_page) < ROW_LIMIT:
+                break
+            start_row += len(df_page)
+
+    if writer is None:
+        print("[INFO] No new rows to insert.", flush=True)
+        return 0
+
+    # one load job for the whole run instead of one per GSC page (each job has a fixed scheduling cost)
+    writer.close()
+    try:
+        return upload_to_bq(spool_path, total_new, start_date, end_date, debug=debug)
+    finally:
+        os.remove(spool_path)
 
 # ---------- MAIN ----------
 if __name__ == "__main__":
     debug_flag = '--debug' in sys.argv
-    ensure_table()
-    df = fetch_gsc_data(START_DATE, END_DATE, debug=debug_flag)
-    print(f"[INFO] Finished fetching all data. Total new rows: {len(df)}", flush=True)
+    ensure_table(bq_client, table_ref)
+    verify_access()
+    total_new = fetch_gsc_data(START_DATE, END_DATE, debug=debug_flag)
+    print(f"[INFO] Finished fetching all data. Total new rows: {total_new}", flush=True)
@@ -0,0 +1,51 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+# ============================================================
+# File: gsc_api_utils.py
+# Revision: Rev.1.0
+# Purpose: Search Console API client helpers: orjson decoding of the
+#          GSC responses and of the service-account key file.
+# ============================================================
+
+import json
+from googleapiclient.discovery import build
+from googleapiclient.model import JsonModel
+
+# orjson is optional: parses the ~5-10 MB page responses several times faster than stdlib json
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+# =================================================
+# Function: load_service_account_info
+# =================================================
+def load_service_account_info(path):
+    """Service-account key file -> dict (orjson when available, stdlib json otherwise)."""
+    with open(path, "rb") as f:
+        content = f.read()
+    return orjson.loads(content) if orjson is not None else json.loads(content)
+
+# =================================================
+# Class: OrjsonModel
+# =================================================
+class OrjsonModel(JsonModel):
+    """JsonModel whose response bodies are decoded with orjson instead of json.loads."""
+
+    def deserialize(self, content):
+        if orjson is None:
+            return super().deserialize(content)
+        try:
+            body = orjson.loads(content)
+        except orjson.JSONDecodeError:
+            return content.decode("utf-8") if isinstance(content, bytes) else content
+        if self._data_wrapper and "data" in body:
+            body = body["data"]
+        return body
+
+# =================================================
+# Function: build_searchconsole
+# =================================================
+def build_searchconsole(credentials, **kwargs):
+    """build('searchconsole', 'v1') with OrjsonModel, also used for the requests of a batch."""
+    return build("searchconsole", "v1", credentials=credentials, model=OrjsonModel(), **kwargs)
@@ -9,6 +9,7 @@
 
 from google.cloud import bigquery
 import pandas as pd
+import numpy as np
 
 # =================================================
 # Function: load_country_map
@@ -75,5 +76,9 @@ def robust_map_country_column(
             return "Kosovo"
         return country_map.get(s, "__NO_COUNTRY__")
 
-    df[new_col] = df[country_col].apply(map_one)
+    # GSC has ~250 distinct country codes: map each distinct value once, then broadcast by
+    # factorize codes instead of calling map_one on every row (NULL -> code -1 -> None)
+    codes, uniques = pd.factorize(df[country_col])
+    mapped = np.array([map_one(v) for v in uniques] + [None], dtype=object)
+    df[new_col] = pd.Series(mapped[codes].tolist(), index=df.index)
     return df
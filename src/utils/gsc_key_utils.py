@@ -0,0 +1,298 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+# ============================================================
+# File: gsc_key_utils.py
+# Revision: Rev.1.0
+# Purpose: SHA256 unique_key builders and a compact in-memory store for
+#          existing keys (used by the fullfetch scripts for client-side dedup).
+# ============================================================
+
+import hashlib
+import logging
+import string
+from datetime import datetime
+import numpy as np
+import pyarrow as pa
+import pyarrow.compute as pc
+
+_HEX_DIGITS = frozenset(string.hexdigits)
+# ASCII characters str.strip() removes (str.isspace), including the \x1c-\x1f separators
+_PY_ASCII_WHITESPACE = " \t\n\r\x0b\x0c\x1c\x1d\x1e\x1f"
+
+# per-row key debugging goes through logging: callers pay only an isEnabledFor() check
+log = logging.getLogger(__name__)
+
+# =================================================
+# Function: strip_lower
+# =================================================
+def strip_lower(arr: pa.Array) -> pa.Array:
+    """
+    Python's s.strip().lower() over an Arrow string array (no NULLs), byte-identical to the per-row str code.
+    ASCII strings go through Arrow's C kernels on the whole buffer. Non-ASCII strings keep exact
+    str semantics via Python, since utf8_lower differs on a few cases (final sigma, dotted I).
+    """
+    out = pc.ascii_lower(pc.utf8_trim(arr, characters=_PY_ASCII_WHITESPACE))
+    is_ascii = pc.string_is_ascii(arr)
+    if pc.all(is_ascii).as_py() is not False:
+        return out
+    values = out.to_pylist()
+    for i in np.flatnonzero(~is_ascii.to_numpy(zero_copy_only=False)):
+        values[i] = arr[int(i)].as_py().strip().lower()
+    return pa.array(values, type=pa.string())
+
+# =================================================
+# Function: sha256_hex_list
+# =================================================
+def sha256_hex_list(strings):
+    """SHA256 hex per string; the UTF-8 encoding is one Arrow cast instead of str.encode() per row."""
+    sha256 = hashlib.sha256
+    return [sha256(b).hexdigest() for b in pa.array(strings, type=pa.string()).cast(pa.binary()).to_pylist()]
+
+# =================================================
+# Function: generate_expanded_unique_key
+# =================================================
+def generate_expanded_unique_key(row, dims):
+    """
+    Generate a unique SHA256 hash key based on the 'Duplicated in Expanded Dimension Space'.
+    
+    Parameters:
+    - row: dict-like object containing the row data (e.g., {'Date': ..., 'Query': ..., 'Page': ..., ...})
+    - dims: list of dimension names (strings) that define the uniqueness for this row
+            e.g., ['date', 'query', 'page', 'country', 'device']
+
+    Mechanism:
+    - Only the dimensions present in 'dims' are considered for uniqueness
+    - Missing or None values are normalized to empty string
+    - String values are stripped and lowercased
+    - Date values are converted to 'YYYY-MM-DD' string
+    - The concatenated string of all dimension values is hashed using SHA256
+    """
+    # canonical mapping: lowercase dim -> actual column name in row dict
+    canonical = {
+        "date": "Date",
+        "query": "Query",
+        "page": "Page",
+        "country": "Country",
+        "device": "Device"
+    }   
+    key_parts = []
+
+    for dim in dims:
+        dim_lower = str(dim).lower()
+        col = canonical.get(dim_lower, None)
+
+        # try several fallbacks to find the value in row
+        val = ""
+        if col and col in row:
+            val = row.get(col)
+        else:
+            # fallback attempts: original dim as-is, lowercase, uppercase
+            val = row.get(dim) if dim in row else row.get(dim_lower) if dim_lower in row else row.get(dim.upper(), None)
+        
+        # Normalize None to empty string
+        if val is None:
+            val = ""
+        # Handle date normalization
+        if dim_lower == "date":
+            if isinstance(val, str):
+                val = val[:10]
+            elif isinstance(val, datetime):
+                val = val.strftime("%Y-%m-%d")
+            else:
+                val = str(val)[:10] if val != "" else ""
+        else:
+            val = str(val).strip().lower()
+            if dim_lower == "page" and val:
+                val = val.rstrip("/")  # normalize trailing slash
+
+        key_parts.append(val)
+
+    key_str = "|".join(key_parts)
+    unique_key = hashlib.sha256(key_str.encode("utf-8")).hexdigest()
+    # optional DEBUG: key parts per row (set this module's logger to DEBUG; costs nothing when off)
+    if log.isEnabledFor(logging.DEBUG):
+        log.debug("key_fields: %s -> unique: %s", dict(zip(dims, key_parts)), unique_key)
+    return unique_key
+
+# =================================================
+# Function: generate_expanded_unique_keys
+# =================================================
+def generate_expanded_unique_keys(df, dims):
+    """
+    Vectorized generate_expanded_unique_key for a whole page of rows.
+
+    Same normalization and SHA256 hex as the per-row function, but the strip/lower/rstrip,
+    date slicing and '|' join run once per column in Arrow compute kernels.
+    Returns a list of keys aligned with df rows.
+    """
+    canonical = {
+        "date": "Date",
+        "query": "Query",
+        "page": "Page",
+        "country": "Country",
+        "device": "Device"
+    }
+    key_parts = []
+
+    for dim in dims:
+        dim_lower = str(dim).lower()
+        col = canonical.get(dim_lower, None)
+        if not (col and col in df.columns):
+            col = next((c for c in (dim, dim_lower, dim.upper()) if c in df.columns), None)
+
+        if col is None:
+            key_parts.append(pa.array([""] * len(df), type=pa.string()))
+            continue
+
+        # str() per value exactly like the per-row function: only None becomes "", NaN/NaT keep their "nan"/"NaT" text
+        vals = pa.array(["" if v is None else str(v) for v in df[col]], type=pa.string())
+        if dim_lower == "date":
+            vals = pc.utf8_slice_codeunits(vals, 0, 10)
+        else:
+            vals = strip_lower(vals)
+            if dim_lower == "page":
+                vals = pc.utf8_rtrim(vals, characters="/")  # normalize trailing slash
+        key_parts.append(vals)
+
+    key_str = pc.binary_join_element_wise(*key_parts, "|") if len(key_parts) > 1 else key_parts[0]
+    return sha256_hex_list(key_str)
+
+# =================================================
+# Function: key_prefix64
+# =================================================
+def key_prefix64(hex_keys) -> np.ndarray:
+    """
+    First 64 bits of each SHA256 hex unique_key as a uint64 array.
+    SHA256 output is uniform, so the prefix identifies a key as well as the full 64-char string
+    for dedup purposes (collision odds ~N²/2^65), at 8 bytes per key.
+    NULL / non-hex legacy keys are dropped: they can never equal a freshly generated key.
+    """
+    hex_keys = [k for k in hex_keys if k]
+    try:
+        raw = bytes.fromhex("".join(k[:16] for k in hex_keys))
+    except ValueError:
+        hex_keys = [k for k in hex_keys if len(k) >= 16 and _HEX_DIGITS.issuperset(k[:16])]
+        raw = bytes.fromhex("".join(k[:16] for k in hex_keys))
+    return np.frombuffer(raw, dtype=">u8").astype(np.uint64)
+
+# =================================================
+# Class: ExistingKeySet
+# =================================================
+class ExistingKeySet:
+    """
+    Drop-in for the `set` of existing unique_keys (`key in s`, `s.add(key)`, `len(s)`).
+
+    Keys loaded from BigQuery live in one sorted uint64 numpy array (8 bytes/key instead of
+    ~120 bytes for a hex str inside a Python set); lookups are a binary search. Keys added
+    during the run go to a small Python set of ints, which is merged into the sorted array
+    once it outgrows COMPACT_MIN_ADDED / 1/8 of the array. Exact on the 64-bit prefix, so unlike
+    a Bloom filter there are no false positives that would silently drop new rows.
+    """
+
+    COMPACT_MIN_ADDED = 1 << 20  # ~70 MB of Python ints before the first merge into the array
+
+    def __init__(self, hex_keys=()):
+        self._base = np.unique(key_prefix64(hex_keys))
+        self._added = set()
+
+    @classmethod
+    def from_prefixes(cls, prefix_chunks):
+        """Build from uint64 prefix arrays (key_prefix64 output, e.g. one per streamed page) without the hex strings."""
+        keys = cls()
+        chunks = [np.asarray(c, dtype=np.uint64) for c in prefix_chunks]
+        if chunks:
+            keys._base = np.unique(np.concatenate(chunks))
+        return keys
+
+    def copy(self):
+        """Independent set over the same loaded keys: shares the sorted base array (replaced, never written in place)."""
+        keys = ExistingKeySet()
+        keys._base = self._base
+        keys._added = set(self._added)
+        return keys
+
+    @staticmethod
+    def _prefix(key):
+        return int(key[:16], 16)
+
+    def __contains__(self, key):
+        if not key:
+            return False
+        try:
+            p = self._prefix(key)
+        except ValueError:
+            return False
+        if p in self._added:
+            return True
+        i = int(np.searchsorted(self._base, np.uint64(p)))
+        return i < len(self._base) and int(self._base[i]) == p
+
+    def add(self, key):
+        if key:
+            self._added.add(self._prefix(key))
+            self._maybe_compact()
+
+    def _maybe_compact(self):
+        """Merge the run's added ints into the sorted array (~8 instead of ~70 bytes per key)."""
+        if len(self._added) < max(self.COMPACT_MIN_ADDED, len(self._base) // 8):
+            return
+        added = np.fromiter(self._added, dtype=np.uint64, count=len(self._added))
+        self._base = np.union1d(self._base, added)
+        self._added = set()
+
+    @staticmethod
+    def _prefix_array(hex_keys):
+        """uint64 prefixes of a page of keys, or None if any key is NULL / malformed."""
+        try:
+            prefixes = np.frombuffer(bytes.fromhex("".join(k[:16] for k in hex_keys)), dtype=">u8").astype(np.uint64)
+        except (ValueError, TypeError):
+            return None
+        return prefixes if len(prefixes) == len(hex_keys) else None
+
+    def _known(self, prefixes):
+        """Vectorized membership of a prefix array: one searchsorted on the base, one C-level map over the added set."""
+        if len(self._base):
+            idx = np.minimum(np.searchsorted(self._base, prefixes), len(self._base) - 1)
+            known = self._base[idx] == prefixes
+        else:
+            known = np.zeros(len(prefixes), dtype=bool)
+        prefix_list = prefixes.tolist()
+        known |= np.fromiter(map(self._added.__contains__, prefix_list), dtype=bool, count=len(prefix_list))
+        return known
+
+    def contains_many(self, hex_keys) -> np.ndarray:
+        """Batch form of `key in s` over one page of keys (nothing is added)."""
+        hex_keys = list(hex_keys)
+        prefixes = self._prefix_array(hex_keys)
+        if prefixes is None:
+            return np.fromiter((key in self for key in hex_keys), dtype=bool, count=len(hex_keys))
+        return self._known(prefixes)
+
+    def add_new(self, hex_keys) -> np.ndarray:
+        """
+        Batch form of the dedup loop `new = key not in s; s.add(key)` over one page of keys.
+        Returns a boolean mask of keys that were neither known nor seen earlier in the page, and adds them.
+        The base lookup is one vectorized searchsorted; only the run's added set is probed per key (C-level map).
+        """
+        hex_keys = list(hex_keys)
+        prefixes = self._prefix_array(hex_keys)
+        if prefixes is None:
+            # NULL / malformed keys in the page: keep the exact per-key semantics
+            mask = np.zeros(len(hex_keys), dtype=bool)
+            for i, key in enumerate(hex_keys):
+                if key not in self:
+                    mask[i] = True
+                    self.add(key)
+            return mask
+
+        known = self._known(prefixes)
+
+        first = np.zeros(len(prefixes), dtype=bool)
+        first[np.unique(prefixes, return_index=True)[1]] = True
+        mask = ~known & first
+        self._added.update(prefixes[mask].tolist())
+        self._maybe_compact()
+        return mask
+
+    def __len__(self):
+        return len(self._base) + len(self._added)
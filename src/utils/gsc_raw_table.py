@@ -0,0 +1,98 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+# ============================================================
+# File: gsc_raw_table.py
+# Revision: Rev.1.0
+# Purpose: Shared schema / table creation / unique_key helpers for the
+#          query+page+date raw table (used by the rev3 and rev4 loaders).
+# ============================================================
+
+from datetime import datetime
+import hashlib
+import pandas as pd
+import pyarrow as pa
+import pyarrow.compute as pc
+from google.cloud import bigquery
+from utils.gsc_key_utils import sha256_hex_list, strip_lower
+
+RAW_SCHEMA = [
+    bigquery.SchemaField("Date", "DATE"),
+    bigquery.SchemaField("Query", "STRING"),
+    bigquery.SchemaField("Page", "STRING"),
+    bigquery.SchemaField("Clicks", "INTEGER"),
+    bigquery.SchemaField("Impressions", "INTEGER"),
+    bigquery.SchemaField("CTR", "FLOAT"),
+    bigquery.SchemaField("Position", "FLOAT"),
+    bigquery.SchemaField("unique_key", "STRING"),
+]
+RAW_PARTITION_FIELD = "Date"  # day partitions: Date-bounded reads and MERGEs only scan the days they touch
+RAW_CLUSTERING_FIELDS = ["Query", "Page"]  # Date is the partition column, so it is not repeated here
+
+# =================================================
+# Function: ensure_table
+# =================================================
+def ensure_table(bq_client, table_ref):
+    """
+    Create the raw table (RAW_SCHEMA, day-partitioned on Date, clustered on Query/Page) if it does not exist yet.
+    Queries against it must filter on Date (require_partition_filter).
+    """
+    try:
+        bq_client.get_table(table_ref)
+        print(f"[INFO] Table {table_ref.table_id} exists.", flush=True)
+    except:
+        print(f"[INFO] Table {table_ref.table_id} not found. Creating...", flush=True)
+        table = bigquery.Table(table_ref, schema=RAW_SCHEMA)
+        table.time_partitioning = bigquery.TimePartitioning(type_=bigquery.TimePartitioningType.DAY, field=RAW_PARTITION_FIELD)
+        table.require_partition_filter = True
+        table.clustering_fields = RAW_CLUSTERING_FIELDS
+        bq_client.create_table(table)
+        print(f"[INFO] Table {table_ref.table_id} created.", flush=True)
+
+# =================================================
+# Function: stable_key
+# =================================================
+def stable_key(row):
+    """
+    Reference (per-row) unique_key: SHA256 hex of normalized query|page|date.
+    src/tests/check_unique_keys.py checks stable_key_series against it.
+    """
+    query = (row.get('Query') or '').strip().lower()
+    page = (row.get('Page') or '').strip().lower().rstrip('/')
+    date_raw = row.get('Date')
+    if isinstance(date_raw, str):
+        date = date_raw[:10]
+    elif isinstance(date_raw, datetime):
+        date = date_raw.strftime("%Y-%m-%d")
+    else:
+        date = str(date_raw)[:10]
+    det_tuple = (query, page, date)
+    s = "|".join(det_tuple)
+    return hashlib.sha256(s.encode('utf-8')).hexdigest()
+
+# =================================================
+# Function: date_key_series
+# =================================================
+def date_key_series(dates):
+    """
+    Date part of stable_key, specialized once per batch on the column dtype
+    instead of stable_key's isinstance() chain on every row.
+    """
+    if pd.api.types.is_datetime64_any_dtype(dates) and not dates.hasnans:
+        return dates.dt.strftime('%Y-%m-%d')
+    if pd.api.types.is_string_dtype(dates) and not dates.hasnans:
+        return dates.str.slice(0, 10)  # GSC returns ISO date strings
+    return pd.Series([str(d)[:10] for d in dates], index=dates.index)  # mixed/NULL dates: stable_key's else-branch
+
+# =================================================
+# Function: stable_key_series
+# =================================================
+def stable_key_series(df):
+    """
+    Vectorized stable_key over a whole batch: same normalization and SHA256 hex, no per-row Series.
+    strip/lower/rstrip and the '|' join run as Arrow kernels over each column's buffer.
+    """
+    query = strip_lower(pa.array(df['Query'].fillna('').astype(str), type=pa.string()))
+    page = pc.utf8_rtrim(strip_lower(pa.array(df['Page'].fillna('').astype(str), type=pa.string())), characters='/')
+    date = pa.array(date_key_series(df['Date']), type=pa.string())
+    joined = pc.binary_join_element_wise(query, page, date, '|')
+    return pd.Series(sha256_hex_list(joined), index=df.index)
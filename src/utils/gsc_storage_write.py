@@ -0,0 +1,145 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+# ============================================================
+# File: gsc_storage_write.py
+# Revision: Rev.1.0
+# Purpose: Append DataFrames to BigQuery through the Storage Write API
+#          (_default stream) instead of one load job per batch.
+# ============================================================
+
+import datetime
+import functools
+import pandas as pd
+from google.protobuf import descriptor_pb2, descriptor_pool
+
+try:
+    from google.protobuf.message_factory import GetMessageClass
+except ImportError:  # protobuf < 4.22
+    from google.protobuf.message_factory import MessageFactory
+    GetMessageClass = lambda desc: MessageFactory(desc.file.pool).GetPrototype(desc)
+
+from google.cloud.bigquery_storage_v1 import BigQueryWriteClient, types, writer
+
+# BigQuery column type -> proto field type accepted by the Write API (DATE = days since epoch)
+_PROTO_TYPES = {
+    "STRING": descriptor_pb2.FieldDescriptorProto.TYPE_STRING,
+    "INTEGER": descriptor_pb2.FieldDescriptorProto.TYPE_INT64,
+    "INT64": descriptor_pb2.FieldDescriptorProto.TYPE_INT64,
+    "FLOAT": descriptor_pb2.FieldDescriptorProto.TYPE_DOUBLE,
+    "FLOAT64": descriptor_pb2.FieldDescriptorProto.TYPE_DOUBLE,
+    "DATE": descriptor_pb2.FieldDescriptorProto.TYPE_INT32,
+}
+MAX_REQUEST_BYTES = 5 * 1024 * 1024  # AppendRows hard limit is 10 MB per request
+_EPOCH = datetime.date(1970, 1, 1)
+
+# =================================================
+# Function: _row_message_class
+# =================================================
+@functools.lru_cache(maxsize=None)
+def _row_message_class(columns):
+    """
+    Proto2 message class with one optional field per (name, bq_type) column, plus its DescriptorProto
+    for the stream's writer_schema. Cached: built once per schema, not per batch.
+    """
+    file_proto = descriptor_pb2.FileDescriptorProto(name="gsc_row.proto", package="gsc", syntax="proto2")
+    msg_proto = file_proto.message_type.add(name="GscRow")
+    for number, (name, bq_type) in enumerate(columns, start=1):
+        msg_proto.field.add(
+            name=name,
+            number=number,
+            type=_PROTO_TYPES[bq_type],
+            label=descriptor_pb2.FieldDescriptorProto.LABEL_OPTIONAL,
+        )
+    pool = descriptor_pool.DescriptorPool()
+    pool.Add(file_proto)
+    return GetMessageClass(pool.FindMessageTypeByName("gsc.GscRow")), msg_proto
+
+@functools.lru_cache(maxsize=None)
+def _write_client(credentials):
+    """One BigQueryWriteClient (gRPC channel, auth) per credentials for the process, not one per appended batch."""
+    return BigQueryWriteClient(credentials=credentials)
+
+def _column_values(series, bq_type):
+    """Column -> list of Python values in proto representation; NULL stays None (field left unset)."""
+    if bq_type == "DATE":
+        dates = pd.to_datetime(series)
+        days = (dates - pd.Timestamp(_EPOCH)).dt.days
+        return [None if pd.isna(d) else int(d) for d in days]
+    values = series.astype(object).where(series.notna(), None).tolist()
+    if bq_type in ("INTEGER", "INT64"):
+        return [None if v is None else int(v) for v in values]
+    if bq_type in ("FLOAT", "FLOAT64"):
+        return [None if v is None else float(v) for v in values]
+    return [None if v is None else str(v) for v in values]
+
+# =================================================
+# Class: AppendRowsError
+# =================================================
+class AppendRowsError(Exception):
+    """Some AppendRows requests failed; failed_rows are the positions in df of the rows that were not appended."""
+
+    def __init__(self, message, failed_rows):
+        super().__init__(message)
+        self.failed_rows = failed_rows
+
+# =================================================
+# Function: append_dataframe
+# =================================================
+def append_dataframe(table_ref, schema, df, credentials=None):
+    """
+    Append df to table_ref (bigquery.TableReference) over the table's _default write stream.
+    schema is the list of bigquery.SchemaField used for the load job; only its columns are sent.
+    Rows are packed into AppendRows requests of up to MAX_REQUEST_BYTES; returns rows appended.
+    Raises AppendRowsError when some requests failed: the rows of the other requests are already committed.
+    """
+    columns = tuple((f.name, f.field_type.upper()) for f in schema)
+    row_cls, msg_proto = _row_message_class(columns)
+
+    col_values = [_column_values(df[name], bq_type) for name, bq_type in columns]
+    serialized = []
+    for values in zip(*col_values):
+        msg = row_cls()
+        for (name, _), v in zip(columns, values):
+            if v is not None:
+                setattr(msg, name, v)
+        serialized.append(msg.SerializeToString())
+    if not serialized:
+        return 0
+
+    write_client = _write_client(credentials)
+    parent = write_client.table_path(table_ref.project, table_ref.dataset_id, table_ref.table_id)
+    template = types.AppendRowsRequest(
+        write_stream=f"{parent}/streams/_default",
+        proto_rows=types.AppendRowsRequest.ProtoData(writer_schema=types.ProtoSchema(proto_descriptor=msg_proto)),
+    )
+    stream = writer.AppendRowsStream(write_client, template)
+    futures, failed_rows, error = [], [], None
+    try:
+        chunk, chunk_start, chunk_bytes = [], 0, 0
+        for i, row in enumerate(serialized + [None]):
+            if row is None or (chunk and chunk_bytes + len(row) > MAX_REQUEST_BYTES):
+                request = types.AppendRowsRequest(
+                    proto_rows=types.AppendRowsRequest.ProtoData(rows=types.ProtoRows(serialized_rows=chunk))
+                )
+                try:
+                    futures.append((stream.send(request), range(chunk_start, i)))
+                except Exception as e:
+                    # stream is gone: this chunk and everything after it was never sent
+                    error = e
+                    failed_rows.extend(range(chunk_start, len(serialized)))
+                    break
+                chunk, chunk_start, chunk_bytes = [], i, 0
+            if row is not None:
+                chunk.append(row)
+                chunk_bytes += len(row)
+        for future, rows in futures:
+            try:
+                future.result()
+            except Exception as e:
+                error = e
+                failed_rows.extend(rows)
+    finally:
+        stream.close()
+    if failed_rows:
+        raise AppendRowsError(f"{len(failed_rows)} of {len(serialized)} rows not appended: {error}", failed_rows)
+    return len(serialized)